@@ -53,7 +53,11 @@ setup(
     download_url='https://github.com/ajkxyz/jpeg4py',
     packages=["jpeg4py"],
     package_dir={"jpeg4py": "src/jpeg4py"},
+    setup_requires=["cffi"],
     install_requires=["cffi", "numpy"],
+    cffi_modules=["src/jpeg4py/_build.py:build_ffi",
+                  "src/jpeg4py/_build.py:build_ffi3"],
+    python_requires=">=3.8",
     keywords=["libjpeg-turbo", "jpeg4py"],
     classifiers=[
         "Development Status :: 4 - Beta",
@@ -61,12 +65,11 @@ setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: BSD License",
         "Operating System :: POSIX",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.2",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
         "Topic :: Software Development :: Libraries"
     ]
 )
@@ -38,10 +38,18 @@ Init module.
 """
 
 # High-level interface
-from jpeg4py._py import JPEG, JPEGRuntimeError
+from jpeg4py._py import (JPEG, JPEGRuntimeError, HandlePool, BufferArena,
+                         DecodeCache, DECODE_MODES, decode_batch,
+                         decode_batch_tensor, decode_flags, yuv_planes)
+from jpeg4py._metrics import Metrics, metrics
+from jpeg4py._headers import (Header, HEADER_INDEX_DTYPE, Validation,
+                              read_header, scan_headers, validate)
+from jpeg4py._stream import iter_members, stream
+from jpeg4py._pipeline import Pipeline
+from jpeg4py._transcode import encode_to_size, thumbnails
 
 # Low-level interface
-from jpeg4py._cffi import ffi, lib, initialize
+from jpeg4py._cffi import ffi, lib, initialize, capabilities
 
 # Constants
 from jpeg4py._cffi import (TJSAMP_444,
@@ -49,6 +57,8 @@ from jpeg4py._cffi import (TJSAMP_444,
                            TJSAMP_420,
                            TJSAMP_GRAY,
                            TJSAMP_440,
+                           TJSAMP_411,
+                           TJSAMP_UNKNOWN,
                            TJPF_RGB,
                            TJPF_BGR,
                            TJPF_RGBX,
@@ -59,7 +69,41 @@ from jpeg4py._cffi import (TJSAMP_444,
                            TJPF_RGBA,
                            TJPF_BGRA,
                            TJPF_ABGR,
-                           TJPF_ARGB)
+                           TJPF_ARGB,
+                           TJFLAG_BOTTOMUP,
+                           TJFLAG_FASTUPSAMPLE,
+                           TJFLAG_NOREALLOC,
+                           TJFLAG_FASTDCT,
+                           TJFLAG_ACCURATEDCT,
+                           TJXOP_NONE,
+                           TJXOP_HFLIP,
+                           TJXOP_VFLIP,
+                           TJXOP_TRANSPOSE,
+                           TJXOP_TRANSVERSE,
+                           TJXOP_ROT90,
+                           TJXOP_ROT180,
+                           TJXOP_ROT270,
+                           TJXOPT_PERFECT,
+                           TJXOPT_TRIM,
+                           TJXOPT_CROP,
+                           TJXOPT_GRAY,
+                           TJXOPT_NOOUTPUT,
+                           TJXOPT_PROGRESSIVE,
+                           TJXOPT_COPYNONE,
+                           TJINIT_COMPRESS,
+                           TJINIT_DECOMPRESS,
+                           TJINIT_TRANSFORM,
+                           TJPARAM_BOTTOMUP,
+                           TJPARAM_NOREALLOC,
+                           TJPARAM_QUALITY,
+                           TJPARAM_SUBSAMP,
+                           TJPARAM_JPEGWIDTH,
+                           TJPARAM_JPEGHEIGHT,
+                           TJPARAM_PRECISION,
+                           TJPARAM_FASTUPSAMPLE,
+                           TJPARAM_FASTDCT,
+                           TJPARAM_PROGRESSIVE,
+                           TJPARAM_LOSSLESS)
 
 # Mappings
-from jpeg4py._cffi import tjPixelSize
+from jpeg4py._cffi import tjPixelSize, tjMCUWidth, tjMCUHeight
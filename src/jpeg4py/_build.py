@@ -0,0 +1,240 @@
+
+"""
+TurboJPEG declarations and the builder of the optional compiled
+(API mode) extension jpeg4py._turbojpeg.
+
+Executed by setup.py through cffi_modules, or directly to build
+the extension in place:
+
+    python src/jpeg4py/_build.py
+"""
+import cffi
+import os
+
+
+#: TurboJPEG API used by the library
+CDEF = """
+
+typedef void *tjhandle;
+
+typedef struct {
+  int x;
+  int y;
+  int w;
+  int h;
+} tjregion;
+
+typedef struct {
+  tjregion r;
+  int op;
+  int options;
+  void *data;
+  void *customFilter;
+} tjtransform;
+
+typedef struct {
+  int num;
+  int denom;
+} tjscalingfactor;
+
+tjhandle tjInitDecompress();
+int tjDestroy(tjhandle handle);
+int tjDecompressToYUV(
+    tjhandle handle,
+    unsigned char *jpegBuf,
+    unsigned long jpegSize,
+    unsigned char *dstBuf,
+    int flags);
+unsigned long tjBufSizeYUV(int width, int height, int subsamp);
+int tjDecompressHeader2(
+    tjhandle handle,
+    unsigned char *jpegBuf,
+    unsigned long jpegSize,
+    int *width,
+    int *height,
+    int *jpegSubsamp);
+int tjDecompress2(
+    tjhandle handle,
+    unsigned char *jpegBuf,
+    unsigned long jpegSize,
+    unsigned char *dstBuf,
+    int width,
+    int pitch,
+    int height,
+    int pixelFormat,
+    int flags);
+tjhandle tjInitCompress();
+int tjCompress2(
+     tjhandle handle,
+     unsigned char *srcBuf,
+     int width,
+     int pitch,
+     int height,
+     int pixelFormat,
+     unsigned char **jpegBuf,
+     unsigned long *jpegSize,
+     int jpegSubsamp,
+     int jpegQual,
+     int flags);
+unsigned long tjBufSize(
+    int width,
+    int height,
+    int jpegSubsamp);
+int tjEncodeYUV2(
+    tjhandle handle,
+    unsigned char *srcBuf,
+    int width,
+    int pitch,
+    int height,
+    int pixelFormat,
+    unsigned char *dstBuf,
+    int subsamp,
+    int flags);
+int tjCompressFromYUV(
+    tjhandle handle,
+    unsigned char *srcBuf,
+    int width,
+    int pad,
+    int height,
+    int subsamp,
+    unsigned char **jpegBuf,
+    unsigned long *jpegSize,
+    int jpegQual,
+    int flags);
+char* tjGetErrorStr();
+tjhandle tjInitTransform();
+int tjTransform(
+    tjhandle handle,
+    unsigned char *jpegBuf,
+    unsigned long jpegSize,
+    int n,
+    unsigned char **dstBufs,
+    unsigned long *dstSizes,
+    tjtransform *transforms,
+    int flags);
+unsigned char *tjAlloc(int bytes);
+void tjFree(unsigned char *buffer);
+tjscalingfactor *tjGetScalingFactors(int *numscalingfactors);
+"""
+
+
+#: TurboJPEG 3 API used when the library provides it
+CDEF3 = """
+tjhandle tj3Init(int initType);
+int tj3Set(tjhandle handle, int param, int value);
+int tj3Get(tjhandle handle, int param);
+int tj3DecompressHeader(
+    tjhandle handle,
+    const unsigned char *jpegBuf,
+    size_t jpegSize);
+int tj3SetScalingFactor(tjhandle handle, tjscalingfactor scalingFactor);
+int tj3SetCroppingRegion(tjhandle handle, tjregion croppingRegion);
+int tj3Decompress8(
+    tjhandle handle,
+    const unsigned char *jpegBuf,
+    size_t jpegSize,
+    unsigned char *dstBuf,
+    int pitch,
+    int pixelFormat);
+int tj3Decompress12(
+    tjhandle handle,
+    const unsigned char *jpegBuf,
+    size_t jpegSize,
+    short *dstBuf,
+    int pitch,
+    int pixelFormat);
+int tj3Decompress16(
+    tjhandle handle,
+    const unsigned char *jpegBuf,
+    size_t jpegSize,
+    unsigned short *dstBuf,
+    int pitch,
+    int pixelFormat);
+int tj3Compress8(
+    tjhandle handle,
+    const unsigned char *srcBuf,
+    int width,
+    int pitch,
+    int height,
+    int pixelFormat,
+    unsigned char **jpegBuf,
+    size_t *jpegSize);
+int tj3Compress12(
+    tjhandle handle,
+    const short *srcBuf,
+    int width,
+    int pitch,
+    int height,
+    int pixelFormat,
+    unsigned char **jpegBuf,
+    size_t *jpegSize);
+int tj3Compress16(
+    tjhandle handle,
+    const unsigned short *srcBuf,
+    int width,
+    int pitch,
+    int height,
+    int pixelFormat,
+    unsigned char **jpegBuf,
+    size_t *jpegSize);
+void tj3Free(void *buffer);
+"""
+
+
+#: Declarations of the helpers available in the compiled extension only
+HELPERS_CDEF = """
+long long jpeg4py_decompress_header(
+    tjhandle handle,
+    size_t jpegBuf,
+    unsigned long jpegSize);
+"""
+
+
+#: Helpers taking buffer addresses as integers and returning
+#: packed results so Python side needs no ffi.new() and ffi.cast()
+HELPERS_SOURCE = """
+static long long jpeg4py_decompress_header(
+    tjhandle handle,
+    size_t jpegBuf,
+    unsigned long jpegSize) {
+  int width, height, subsamp;
+  if (tjDecompressHeader2(handle, (unsigned char *)jpegBuf, jpegSize,
+                          &width, &height, &subsamp)) {
+    return -1;
+  }
+  return ((long long)width << 32) | ((long long)height << 8) |
+         (subsamp & 0xFF);
+}
+"""
+
+
+def build_ffi(tj3=False):
+    """Returns cffi builder of jpeg4py._turbojpeg.
+
+    The declarations are compiled as is, so turbojpeg.h is not required,
+    only the library to link with. The extension is optional:
+    if it fails to build, the library works in ABI mode.
+
+    Parameters:
+        tj3: build jpeg4py._turbojpeg3 with TurboJPEG 3 API instead,
+             it fails to link with older libraries.
+    """
+    cdef = CDEF + CDEF3 if tj3 else CDEF
+    ffibuilder = cffi.FFI()
+    ffibuilder.cdef(cdef + HELPERS_CDEF)
+    ffibuilder.set_source(
+        "jpeg4py._turbojpeg3" if tj3 else "jpeg4py._turbojpeg",
+        cdef + HELPERS_SOURCE, libraries=["turbojpeg"], optional=True)
+    return ffibuilder
+
+
+def build_ffi3():
+    """Returns cffi builder of jpeg4py._turbojpeg3.
+    """
+    return build_ffi(True)
+
+
+if __name__ == "__main__":
+    for tj3 in (False, True):
+        build_ffi(tj3).compile(tmpdir=os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
@@ -37,6 +37,7 @@ Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
 libjpeg-turbo cffi bindings.
 """
 import cffi
+import os
 import threading
 
 
@@ -46,6 +47,8 @@ TJSAMP_422 = 1
 TJSAMP_420 = 2
 TJSAMP_GRAY = 3
 TJSAMP_440 = 4
+TJSAMP_411 = 5
+TJSAMP_UNKNOWN = -1
 
 #: Pixel formats
 TJPF_RGB = 0
@@ -60,6 +63,50 @@ TJPF_BGRA = 8
 TJPF_ABGR = 9
 TJPF_ARGB = 10
 
+#: Flags
+TJFLAG_BOTTOMUP = 2
+TJFLAG_FASTUPSAMPLE = 256
+TJFLAG_NOREALLOC = 1024
+TJFLAG_FASTDCT = 2048
+TJFLAG_ACCURATEDCT = 4096
+
+#: Transform operations
+TJXOP_NONE = 0
+TJXOP_HFLIP = 1
+TJXOP_VFLIP = 2
+TJXOP_TRANSPOSE = 3
+TJXOP_TRANSVERSE = 4
+TJXOP_ROT90 = 5
+TJXOP_ROT180 = 6
+TJXOP_ROT270 = 7
+
+#: Transform options
+TJXOPT_PERFECT = 1
+TJXOPT_TRIM = 2
+TJXOPT_CROP = 4
+TJXOPT_GRAY = 8
+TJXOPT_NOOUTPUT = 16
+TJXOPT_PROGRESSIVE = 32
+TJXOPT_COPYNONE = 64
+
+#: TurboJPEG 3 handle types
+TJINIT_COMPRESS = 0
+TJINIT_DECOMPRESS = 1
+TJINIT_TRANSFORM = 2
+
+#: TurboJPEG 3 parameters
+TJPARAM_BOTTOMUP = 1
+TJPARAM_NOREALLOC = 2
+TJPARAM_QUALITY = 3
+TJPARAM_SUBSAMP = 4
+TJPARAM_JPEGWIDTH = 5
+TJPARAM_JPEGHEIGHT = 6
+TJPARAM_PRECISION = 7
+TJPARAM_FASTUPSAMPLE = 9
+TJPARAM_FASTDCT = 10
+TJPARAM_PROGRESSIVE = 12
+TJPARAM_LOSSLESS = 15
+
 
 #: Pixel format to Bytes per pixel mapping
 tjPixelSize = {TJPF_RGB: 3, TJPF_BGR: 3, TJPF_RGBX: 4, TJPF_BGRX: 4,
@@ -67,6 +114,16 @@ tjPixelSize = {TJPF_RGB: 3, TJPF_BGR: 3, TJPF_RGBX: 4, TJPF_BGRX: 4,
                TJPF_BGRA: 4, TJPF_ABGR: 4, TJPF_ARGB: 4}
 
 
+#: Subsampling to MCU block width mapping
+tjMCUWidth = {TJSAMP_444: 8, TJSAMP_422: 16, TJSAMP_420: 16, TJSAMP_GRAY: 8,
+              TJSAMP_440: 8, TJSAMP_411: 32}
+
+
+#: Subsampling to MCU block height mapping
+tjMCUHeight = {TJSAMP_444: 8, TJSAMP_422: 8, TJSAMP_420: 16, TJSAMP_GRAY: 8,
+               TJSAMP_440: 16, TJSAMP_411: 8}
+
+
 #: ffi parser
 ffi = None
 
@@ -75,111 +132,40 @@ ffi = None
 lib = None
 
 
+#: Whether the compiled extension jpeg4py._turbojpeg(3) is used
+api_mode = False
+
+
+#: Whether TurboJPEG 3 API (tj3* functions) is available
+tj3 = False
+
+
 #: Lock
 lock = threading.Lock()
 
 
-def _initialize(backends):
+def _initialize(backends, api):
     global lib
     if lib is not None:
         return
-    # C function definitions
-    src = """
-    typedef void *tjhandle;
-
-    typedef struct {
-      int x;
-      int y;
-      int w;
-      int h;
-    } tjregion;
-
-    typedef struct {
-      tjregion r;
-      int op;
-      int options;
-      void *data;
-      void *customFilter;
-    } tjtransform;
-
-    typedef struct {
-      int num;
-      int denom;
-    } tjscalingfactor;
-
-    tjhandle tjInitDecompress();
-    int tjDestroy(tjhandle handle);
-    int tjDecompressToYUV(
-        tjhandle handle,
-        unsigned char *jpegBuf,
-        unsigned long jpegSize,
-        unsigned char *dstBuf,
-        int flags);
-    unsigned long tjBufSizeYUV(int width, int height, int subsamp);
-    int tjDecompressHeader2(
-        tjhandle handle,
-        unsigned char *jpegBuf,
-        unsigned long jpegSize,
-        int *width,
-        int *height,
-        int *jpegSubsamp);
-    int tjDecompress2(
-        tjhandle handle,
-        unsigned char *jpegBuf,
-        unsigned long jpegSize,
-        unsigned char *dstBuf,
-        int width,
-        int pitch,
-        int height,
-        int pixelFormat,
-        int flags);
-    tjhandle tjInitCompress();
-    int tjCompress2(
-         tjhandle handle,
-         unsigned char *srcBuf,
-         int width,
-         int pitch,
-         int height,
-         int pixelFormat,
-         unsigned char **jpegBuf,
-         unsigned long *jpegSize,
-         int jpegSubsamp,
-         int jpegQual,
-         int flags);
-    unsigned long tjBufSize(
-        int width,
-        int height,
-        int jpegSubsamp);
-    int tjEncodeYUV2(
-        tjhandle handle,
-        unsigned char *srcBuf,
-        int width,
-        int pitch,
-        int height,
-        int pixelFormat,
-        unsigned char *dstBuf,
-        int subsamp,
-        int flags);
-    char* tjGetErrorStr();
-    tjhandle tjInitTransform();
-    int tjTransform(
-        tjhandle handle,
-        unsigned char *jpegBuf,
-        unsigned long jpegSize,
-        int n,
-        unsigned char **dstBufs,
-        unsigned long *dstSizes,
-        tjtransform *transforms,
-        int flags);
-    unsigned char *tjAlloc(int bytes);
-    void tjFree(unsigned char *buffer);
-    tjscalingfactor *tjGetScalingFactors(int *numscalingfactors);
-    """
+    global ffi, api_mode, tj3
+    if api:
+        try:
+            from jpeg4py._turbojpeg3 import ffi as ffi_, lib as lib_
+        except ImportError:
+            try:
+                from jpeg4py._turbojpeg import ffi as ffi_, lib as lib_
+            except ImportError:
+                lib_ = None
+        if lib_ is not None:
+            ffi, lib, api_mode = ffi_, lib_, True
+            tj3 = hasattr(lib, "tj3Init")
+            return
 
     # Parse
-    global ffi
+    from jpeg4py._build import CDEF, CDEF3
     ffi = cffi.FFI()
-    ffi.cdef(src)
+    ffi.cdef(CDEF + CDEF3)
 
     # Load library
     for libnme in backends:
@@ -191,6 +177,22 @@ def _initialize(backends):
     else:
         ffi = None
         raise OSError("Could not load libjpeg-turbo library")
+    # Symbols missing in older libraries raise AttributeError on access
+    tj3 = hasattr(lib, "tj3Init")
+
+
+def capabilities():
+    """Loads the library if it was not loaded yet and returns dictionary
+    of its features:
+        api_mode: the compiled extension is used,
+        tj3: TurboJPEG 3 API is available,
+        cropping: regions are decoded without lossless transform,
+        precision: 12 and 16-bit JPEG are supported,
+        lossless: lossless JPEG is supported.
+    """
+    initialize()
+    return {"api_mode": api_mode, "tj3": tj3, "cropping": tj3,
+            "precision": tj3, "lossless": tj3}
 
 
 def initialize(
@@ -198,15 +200,30 @@ def initialize(
         "libturbojpeg.so.0",  # for Ubuntu
         "turbojpeg.dll",  # for Windows
         "/opt/libjpeg-turbo/lib64/libturbojpeg.0.dylib",  # for Mac OS X
-        )):
+        ), api=True):
     """Loads the shared library if it was not loaded yet.
 
     Parameters:
         backends: tuple of shared library file names to try to load.
+        api: use the compiled extension jpeg4py._turbojpeg3
+             or jpeg4py._turbojpeg if it was built (it is linked
+             with the system library, backends are ignored).
     """
     global lib
     if lib is not None:
         return
     global lock
     with lock:
-        _initialize(backends)
+        _initialize(backends, api)
+
+
+def _after_fork():
+    """Resets the lock which may be held by other thread at the time of
+    fork(), loaded library stays valid in the child.
+    """
+    global lock
+    lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
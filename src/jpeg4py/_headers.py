@@ -0,0 +1,362 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+"""
+Pure Python JPEG header scanner which reads only the markers up to SOFn
+and structural validator.
+"""
+from collections import namedtuple
+from jpeg4py._cffi import (TJSAMP_444, TJSAMP_422, TJSAMP_420, TJSAMP_GRAY,
+                           TJSAMP_440, TJSAMP_411, TJSAMP_UNKNOWN)
+from jpeg4py._py import JPEGRuntimeError, _parallel_map
+import multiprocessing
+import numpy
+import os
+
+
+#: SOFn markers
+SOF_MARKERS = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                         0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+
+
+#: Progressive SOFn markers
+PROGRESSIVE_MARKERS = frozenset((0xC2, 0xC6, 0xCA, 0xCE))
+
+
+#: Markers without the length field
+STANDALONE_MARKERS = frozenset((0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5,
+                                0xD6, 0xD7, 0xD8, 0xD9))
+
+
+#: Luminance sampling factors (h, v) to subsampling mapping
+_subsamplings = {(1, 1): TJSAMP_444, (2, 1): TJSAMP_422,
+                 (2, 2): TJSAMP_420, (1, 2): TJSAMP_440,
+                 (4, 1): TJSAMP_411}
+
+
+#: Parsed header
+Header = namedtuple("Header", ("width", "height", "subsampling",
+                               "components", "progressive"))
+
+
+#: Result of validate(): status is "valid", "truncated" or "corrupt",
+#: offset is the position the problem was found at
+#: (or the end of EOI marker for valid data)
+Validation = namedtuple("Validation", ("status", "offset", "message"))
+
+
+#: dtype of the index produced by scan_headers()
+HEADER_INDEX_DTYPE = numpy.dtype([
+    ("path_id", numpy.int64), ("width", numpy.int32),
+    ("height", numpy.int32), ("subsampling", numpy.int8),
+    ("components", numpy.int8), ("progressive", numpy.bool_),
+    ("file_size", numpy.int64)])
+
+
+class _Reader(object):
+    """Sequential reader over a file or a memory buffer
+    which skips data without reading it.
+    """
+    def __init__(self, source, chunk_size):
+        self.chunk_size = chunk_size
+        self.pos = 0
+        if isinstance(source, str) or hasattr(source, "__fspath__"):
+            self.fin = open(source, "rb")
+            self.buf = b""
+        else:
+            self.fin = None
+            self.buf = memoryview(source).cast("B")
+
+    def close(self):
+        if self.fin is not None:
+            self.fin.close()
+
+    def read(self, n):
+        if self.pos + n > len(self.buf) and self.fin is not None:
+            self.buf = (bytes(self.buf[self.pos:]) +
+                        self.fin.read(max(n, self.chunk_size)))
+            self.pos = 0
+        if self.pos + n > len(self.buf):
+            raise JPEGRuntimeError("Unexpected end of JPEG data", -1)
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def skip(self, n):
+        left = len(self.buf) - self.pos
+        if n <= left or self.fin is None:
+            self.pos += n
+            return
+        self.fin.seek(n - left, os.SEEK_CUR)
+        self.buf = b""
+        self.pos = 0
+
+
+def _read_marker(reader):
+    """Returns the next marker code skipping fill bytes.
+    """
+    if reader.read(1)[0] != 0xFF:
+        raise JPEGRuntimeError("Marker expected", -1)
+    code = 0xFF
+    while code == 0xFF:
+        code = reader.read(1)[0]
+    return code
+
+
+def _read_length(reader):
+    data = reader.read(2)
+    length = (data[0] << 8) | data[1]
+    if length < 2:
+        raise JPEGRuntimeError("Invalid segment length %d" % length, -1)
+    return length
+
+
+def read_header(source, chunk_size=4096):
+    """Parses JPEG markers up to SOFn without TurboJPEG
+    and without reading the rest of the file.
+
+    Parameters:
+        source: file name or object supporting buffer protocol
+                (numpy array, bytes, etc.).
+        chunk_size: size of the reads from file.
+
+    Returns:
+        Header(width, height, subsampling, components, progressive),
+        subsampling is TJSAMP_UNKNOWN if it does not match any TJSAMP_*.
+    """
+    reader = _Reader(source, chunk_size)
+    try:
+        if _read_marker(reader) != 0xD8:
+            raise JPEGRuntimeError("Not a JPEG file: SOI marker expected",
+                                   -1)
+        while True:
+            code = _read_marker(reader)
+            if code in STANDALONE_MARKERS:
+                if code in (0xD8, 0xD9):
+                    break
+                continue
+            length = _read_length(reader)
+            if code == 0xDA:
+                break
+            if code not in SOF_MARKERS:
+                reader.skip(length - 2)
+                continue
+            data = reader.read(length - 2)
+            if len(data) < 6:
+                break
+            height = (data[1] << 8) | data[2]
+            width = (data[3] << 8) | data[4]
+            components = data[5]
+            if len(data) < 6 + components * 3:
+                break
+            sampling = [(data[7 + i * 3] >> 4, data[7 + i * 3] & 15)
+                        for i in range(components)]
+            if components == 1:
+                subsampling = TJSAMP_GRAY
+            elif (components == 3 and sampling[1] == (1, 1) and
+                  sampling[2] == (1, 1)):
+                subsampling = _subsamplings.get(sampling[0], TJSAMP_UNKNOWN)
+            else:
+                subsampling = TJSAMP_UNKNOWN
+            return Header(width, height, subsampling, components,
+                          code in PROGRESSIVE_MARKERS)
+        raise JPEGRuntimeError("Invalid JPEG header: no SOFn marker", -1)
+    finally:
+        reader.close()
+
+
+def scan_headers(paths, workers=None, fnme=None, chunk_size=4096):
+    """Reads headers of the files with read_header() in parallel.
+
+    Parameters:
+        paths: sequence of file names.
+        workers: number of files read at once, at most POOL_SIZE
+                 (defaults to cpu count).
+        fnme: .npy file name to write the index to
+              (it can be loaded later with numpy.load(fnme, mmap_mode="r"))
+              or None to keep it in memory.
+        chunk_size: size of the reads from file.
+
+    Returns:
+        numpy structured array of HEADER_INDEX_DTYPE, path_id is the index
+        in paths, for unreadable files width and height are zero
+        and subsampling is TJSAMP_UNKNOWN.
+    """
+    paths = list(paths)
+    if fnme is None:
+        index = numpy.zeros(len(paths), dtype=HEADER_INDEX_DTYPE)
+    else:
+        index = numpy.lib.format.open_memmap(
+            fnme, mode="w+", dtype=HEADER_INDEX_DTYPE, shape=(len(paths),))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def scan(i):
+        row = index[i]
+        row["path_id"] = i
+        try:
+            row["file_size"] = os.path.getsize(paths[i])
+            header = read_header(paths[i], chunk_size)
+        except (OSError, JPEGRuntimeError):
+            row["subsampling"] = TJSAMP_UNKNOWN
+            return
+        row["width"] = header.width
+        row["height"] = header.height
+        row["subsampling"] = header.subsampling
+        row["components"] = header.components
+        row["progressive"] = header.progressive
+
+    _parallel_map(scan, range(len(paths)), workers)
+    if fnme is not None:
+        index.flush()
+    return index
+
+
+def _markers(data):
+    """Returns positions and codes of all markers in data
+    (0xFF not followed by 0x00 stuffing or another 0xFF fill byte).
+    """
+    ffs = numpy.flatnonzero(data[:-1] == 0xFF)
+    codes = data[ffs + 1]
+    keep = (codes != 0x00) & (codes != 0xFF)
+    return ffs[keep], codes[keep]
+
+
+def validate(source):
+    """Checks JPEG marker structure without entropy decoding.
+
+    Segment lengths, SOFn, DRI and SOS contents and marker order
+    are checked, entropy-coded data is scanned for markers only:
+    restart markers should follow the DRI interval in sequence
+    and every scan should be terminated by a marker.
+    Data after EOI is ignored.
+
+    Parameters:
+        source: file name or object supporting buffer protocol
+                (numpy array, bytes, etc.).
+
+    Returns:
+        Validation(status, offset, message), status is "valid",
+        "truncated" (data ends before EOI) or "corrupt".
+    """
+    if isinstance(source, str) or hasattr(source, "__fspath__"):
+        data = numpy.fromfile(source, dtype=numpy.uint8)
+    else:
+        data = numpy.frombuffer(memoryview(source).cast("B"),
+                                dtype=numpy.uint8)
+    mv = memoryview(data)
+    size = len(data)
+
+    def truncated(pos, message="Unexpected end of JPEG data"):
+        return Validation("truncated", pos, message)
+
+    def corrupt(pos, message):
+        return Validation("corrupt", pos, message)
+
+    if bytes(mv[:2]) != b"\xFF\xD8":
+        if b"\xFF\xD8".startswith(bytes(mv[:2])):
+            return truncated(size)
+        return corrupt(0, "Not a JPEG file: SOI marker expected")
+    marks = codes = None
+    frame = False
+    scans = 0
+    restart = 0
+    pos = 2
+    while True:
+        if pos >= size:
+            return truncated(pos)
+        if mv[pos] != 0xFF:
+            return corrupt(pos, "Marker expected")
+        start = pos
+        while pos < size and mv[pos] == 0xFF:
+            pos += 1
+        if pos >= size:
+            return truncated(pos)
+        code = mv[pos]
+        pos += 1
+        if code == 0xD9:
+            if not scans:
+                return corrupt(start, "No image data before EOI")
+            return Validation("valid", pos, "")
+        if code == 0x01:
+            continue
+        if code < 0xC0 or code in STANDALONE_MARKERS:
+            return corrupt(start, "Unexpected marker 0x%02X" % code)
+        if pos + 2 > size:
+            return truncated(size)
+        length = (mv[pos] << 8) | mv[pos + 1]
+        end = pos + length
+        if length < 2:
+            return corrupt(pos, "Invalid segment length %d" % length)
+        if end > size:
+            return truncated(size)
+        if code in SOF_MARKERS:
+            components = mv[pos + 7] if length >= 8 else 0
+            if (frame or not components or length != 8 + components * 3 or
+                    not ((mv[pos + 5] << 8) | mv[pos + 6])):
+                return corrupt(start, "Invalid SOFn segment")
+            frame = True
+        elif code == 0xDD:
+            if length != 4:
+                return corrupt(start, "Invalid DRI segment")
+            restart = (mv[pos + 2] << 8) | mv[pos + 3]
+        elif code == 0xDA:
+            components = mv[pos + 2] if length >= 3 else 0
+            if not frame:
+                return corrupt(start, "SOS marker before SOFn")
+            if not 1 <= components <= 4 or length != 6 + components * 2:
+                return corrupt(start, "Invalid SOS segment")
+            scans += 1
+            if marks is None:
+                marks, codes = _markers(data)
+            i = numpy.searchsorted(marks, end)
+            rst = codes[i:].astype(numpy.int32) - 0xD0
+            other = numpy.flatnonzero((rst < 0) | (rst > 7))
+            n = other[0] if len(other) else len(rst)
+            if n:
+                if not restart:
+                    return corrupt(int(marks[i]), "Unexpected restart "
+                                   "marker without DRI segment")
+                wrong = numpy.flatnonzero(rst[:n] != numpy.arange(n) % 8)
+                if len(wrong):
+                    return corrupt(int(marks[i + wrong[0]]),
+                                   "Restart markers out of order")
+            if i + n >= len(marks):
+                return truncated(size, "Unexpected end of entropy-coded "
+                                 "data")
+            # Fill bytes before the marker are skipped by the loop
+            pos = int(marks[i + n])
+            continue
+        pos = end
@@ -0,0 +1,131 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+"""
+Optional instrumentation of the library calls.
+"""
+import threading
+import time
+
+
+#: Upper bounds of the latency histogram buckets in microseconds
+BUCKETS_US = tuple(1 << i for i in range(25))
+
+
+class Metrics(object):
+    """Counters and latency histograms of the library calls.
+
+    Disabled by default, in which case the only cost per call
+    is the start() check.
+
+    Attributes:
+        enabled: whether the calls are recorded.
+    """
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._ops = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """Zeroes all counters.
+        """
+        with self._lock:
+            self._ops = {}
+
+    def add_hook(self, hook):
+        """Adds callback called after each recorded call as
+        hook(op, seconds, bytes_in, pixels_out, error), where error is
+        the library return code (0 on success), e.g. to feed StatsD.
+        """
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h is not hook]
+
+    def start(self):
+        """Returns start time if recording is enabled or None.
+        """
+        return time.perf_counter() if self.enabled else None
+
+    def record(self, op, t0, bytes_in=0, pixels_out=0, error=0):
+        """Records the call started at t0 (returned by start()).
+        """
+        seconds = time.perf_counter() - t0
+        bucket = min(int(seconds * 1e6).bit_length(), len(BUCKETS_US) - 1)
+        with self._lock:
+            stats = self._ops.get(op)
+            if stats is None:
+                stats = {"calls": 0, "seconds": 0.0, "bytes_in": 0,
+                         "pixels_out": 0, "errors": {},
+                         "histogram": [0] * len(BUCKETS_US)}
+                self._ops[op] = stats
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["bytes_in"] += bytes_in
+            stats["pixels_out"] += pixels_out
+            stats["histogram"][bucket] += 1
+            if error:
+                stats["errors"][error] = stats["errors"].get(error, 0) + 1
+            hooks = self._hooks
+        for hook in hooks:
+            hook(op, seconds, bytes_in, pixels_out, error)
+
+    def snapshot(self):
+        """Returns dictionary with the counters of each operation
+        (histogram maps upper bucket bound in microseconds to the number of
+        calls) and the handle pools statistics.
+        """
+        from jpeg4py._py import JPEG
+        with self._lock:
+            ops = {}
+            for op, stats in self._ops.items():
+                ops[op] = dict(stats, errors=dict(stats["errors"]),
+                               histogram=dict(
+                                   (b, n) for b, n in zip(
+                                       BUCKETS_US, stats["histogram"]) if n))
+        return {"enabled": self.enabled, "ops": ops, "pools": JPEG.stats()}
+
+
+#: Global metrics instance used by the library
+metrics = Metrics()
@@ -0,0 +1,270 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+
+"""
+Prefetching decode pipeline for feeding training loops.
+"""
+import collections
+from jpeg4py._cffi import TJPF_RGB
+from jpeg4py._py import JPEG
+import multiprocessing
+import queue
+import threading
+import time
+
+
+class Pipeline(object):
+    """Decodes sources on dedicated threads ahead of the consumer.
+
+    A source is taken from the iterable only when there is room for
+    its result, so at most prefetch batches are kept decoded and ready
+    besides the images being decoded by the workers. Handles are released
+    right after each image is decoded.
+
+    Iterating over the pipeline yields images (or lists of batch_size
+    images), the first exception raised by the sources iterable, decoding
+    or transforms is reraised to the consumer, and the pipeline is closed
+    once the iteration stops.
+
+    Attributes:
+        workers: number of decoding threads.
+        batch_size: number of images in a batch or None to yield
+                    the images one by one.
+        prefetch: maximum number of decoded batches kept ready.
+        ordered: whether to yield the images in the order of the sources
+                 or as soon as they are decoded.
+    """
+    def __init__(self, sources, transforms=(), workers=None, batch_size=None,
+                 prefetch=2, ordered=True, pixfmt=TJPF_RGB, scale=None,
+                 max_size=None, lib_=None, mode=None, flags=None):
+        """Constructor, starts decoding immediately.
+
+        Parameters:
+            sources: iterable of JPEG objects or sources accepted by JPEG().
+            transforms: sequence of callables applied in order to each
+                        decoded image on the worker, each one should
+                        return the new image.
+            workers: number of decoding threads (defaults to cpu count).
+            batch_size: number of images in a batch or None.
+            prefetch: maximum number of decoded batches kept ready.
+            ordered: whether to keep the order of the sources.
+            pixfmt: pixel format of the output.
+            scale: desired scale (see JPEG.get_scaling_factor()).
+            max_size: maximum output size (see JPEG.get_scaling_factor()).
+            lib_: cffi handle to loaded shared library.
+            mode: speed/accuracy trade-off from DECODE_MODES.
+            flags: TJFLAG_* flags (see decode_flags()).
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if workers < 1 or prefetch < 1 or (batch_size is not None and
+                                           batch_size < 1):
+            raise ValueError(
+                "workers, prefetch and batch_size should be positive")
+        self.workers = workers
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.ordered = ordered
+        self._sources = sources
+        self._transforms = tuple(transforms)
+        self._decode_kwargs = dict(pixfmt=pixfmt, scale=scale,
+                                   max_size=max_size, mode=mode, flags=flags)
+        self._lib = lib_
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(
+            prefetch * (batch_size or 1) + workers)
+        self._tasks = queue.Queue()
+        self._stop = threading.Event()
+        self._done = {} if ordered else collections.deque()
+        self._count = None
+        self._taken = 0
+        self._error = None
+        self._stats = dict((stage, [0, 0.0]) for stage in (
+            "read", "decode", "transform", "wait"))
+        self._threads = [threading.Thread(
+            target=self._feed, name="jpeg4py pipeline feeder")]
+        self._threads.extend(threading.Thread(
+            target=self._work, name="jpeg4py pipeline worker %d" % i)
+            for i in range(workers))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _add_time(self, stage, seconds):
+        # Called with self._cond held
+        stats = self._stats[stage]
+        stats[0] += 1
+        stats[1] += seconds
+
+    def _feed(self):
+        count = 0
+        try:
+            sources = iter(self._sources)
+            while not self._stop.is_set():
+                t0 = time.perf_counter()
+                try:
+                    source = next(sources)
+                except StopIteration:
+                    break
+                with self._cond:
+                    self._add_time("read", time.perf_counter() - t0)
+                while not self._slots.acquire(timeout=0.1):
+                    if self._stop.is_set():
+                        return
+                self._tasks.put((count, source))
+                count += 1
+        except Exception as e:
+            with self._cond:
+                self._error = e
+        finally:
+            with self._cond:
+                self._count = count
+                self._cond.notify_all()
+            for _ in range(self.workers):
+                self._tasks.put(None)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None or self._stop.is_set():
+                return
+            index, source = task
+            t0 = time.perf_counter()
+            t1 = t2 = None
+            try:
+                jp = source if isinstance(source, JPEG) else JPEG(
+                    source, self._lib)
+                with jp:
+                    image = jp.decode(**self._decode_kwargs)
+                t1 = time.perf_counter()
+                for transform in self._transforms:
+                    image = transform(image)
+                t2 = time.perf_counter()
+                result = image, None
+            except Exception as e:
+                result = None, e
+            with self._cond:
+                if t1 is not None:
+                    self._add_time("decode", t1 - t0)
+                if t2 is not None and self._transforms:
+                    self._add_time("transform", t2 - t1)
+                if self.ordered:
+                    self._done[index] = result
+                else:
+                    self._done.append(result)
+                self._cond.notify_all()
+
+    def _ready(self):
+        """Returns the number of images the next batch takes (0 at the end)
+        if all of them are decoded or None.
+        """
+        want = self.batch_size or 1
+        if self._count is not None:
+            want = min(want, self._count - self._taken)
+        if self.ordered:
+            have = 0
+            while have < want and self._taken + have in self._done:
+                have += 1
+        else:
+            have = len(self._done)
+        return want if have >= want else None
+
+    def _next_batch(self):
+        t0 = time.perf_counter()
+        with self._cond:
+            while True:
+                n = self._ready()
+                if n is not None:
+                    break
+                self._cond.wait()
+            if self.ordered:
+                results = [self._done.pop(self._taken + i) for i in range(n)]
+            else:
+                results = [self._done.popleft() for _ in range(n)]
+            self._taken += n
+            self._add_time("wait", time.perf_counter() - t0)
+        for _ in range(n):
+            self._slots.release()
+        if n == 0 and self._error is not None:
+            raise self._error
+        for _image, error in results:
+            if error is not None:
+                raise error
+        return [image for image, _error in results]
+
+    def __iter__(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                if self.batch_size is None:
+                    yield batch[0]
+                else:
+                    yield batch
+        finally:
+            self.close()
+
+    def stats(self):
+        """Returns dictionary with the number of items and the total
+        time in seconds of each stage: reading sources, decoding,
+        transforms and waiting of the consumer, and the number
+        of ready images.
+        """
+        with self._cond:
+            stats = dict((stage, {"count": count, "seconds": seconds})
+                         for stage, (count, seconds) in self._stats.items())
+            stats["ready"] = len(self._done)
+        return stats
+
+    def close(self):
+        """Stops the threads and drops the decoded images,
+        waits for the images being decoded.
+        """
+        self._stop.set()
+        for _ in range(self.workers):
+            self._tasks.put(None)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        with self._cond:
+            self._done.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -36,10 +36,84 @@ Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
 """
 Helper classes for libjpeg-turbo cffi bindings.
 """
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import hashlib
 import jpeg4py._cffi as jpeg
-from jpeg4py._cffi import TJPF_RGB
+from jpeg4py._metrics import metrics
+from jpeg4py._cffi import (TJPF_RGB, TJPF_GRAY, TJPF_RGBX, TJSAMP_444,
+                           TJSAMP_420, TJSAMP_GRAY, TJFLAG_BOTTOMUP,
+                           TJFLAG_NOREALLOC, TJFLAG_FASTDCT,
+                           TJFLAG_FASTUPSAMPLE, TJXOP_NONE,
+                           TJXOPT_PERFECT, TJXOPT_TRIM, TJXOPT_CROP,
+                           TJXOPT_GRAY, TJXOPT_PROGRESSIVE, TJXOPT_COPYNONE,
+                           TJPARAM_BOTTOMUP, TJPARAM_NOREALLOC,
+                           TJPARAM_QUALITY, TJPARAM_SUBSAMP,
+                           TJPARAM_PRECISION, TJPARAM_FASTUPSAMPLE,
+                           TJPARAM_FASTDCT, TJPARAM_PROGRESSIVE,
+                           TJPARAM_LOSSLESS)
+import mmap
+import multiprocessing
 import numpy
 import os
+import threading
+import weakref
+
+
+def tjscaled(dimension, scaling_factor):
+    """Returns image dimension scaled by (num, denom) scaling factor.
+    """
+    return ((dimension * scaling_factor[0] + scaling_factor[1] - 1) //
+            scaling_factor[1])
+
+
+def yuv_planes(width, height, subsampling, pad=4):
+    """Returns geometry of YUV planes as produced by tjDecompressToYUV().
+
+    Parameters:
+        width: image width.
+        height: image height.
+        subsampling: level of chrominance subsampling.
+        pad: row alignment of each plane in bytes.
+
+    Returns:
+        list of (height, width, stride) tuples, one per plane.
+    """
+    mcu_w = jpeg.tjMCUWidth[subsampling]
+    mcu_h = jpeg.tjMCUHeight[subsampling]
+    pw = (width + mcu_w // 8 - 1) // (mcu_w // 8) * (mcu_w // 8)
+    ph = (height + mcu_h // 8 - 1) // (mcu_h // 8) * (mcu_h // 8)
+    planes = [(ph, pw)]
+    if subsampling != TJSAMP_GRAY:
+        planes.append((ph * 8 // mcu_h, pw * 8 // mcu_w))
+        planes.append(planes[-1])
+    return [(h, w, (w + pad - 1) // pad * pad) for h, w in planes]
+
+
+#: Decode mode to flags mapping
+DECODE_MODES = {"accurate": 0,
+                "fastdct": TJFLAG_FASTDCT,
+                "fastupsample": TJFLAG_FASTUPSAMPLE,
+                "fast": TJFLAG_FASTDCT | TJFLAG_FASTUPSAMPLE}
+
+
+def decode_flags(mode=None, flags=None):
+    """Returns flags for the decompression functions.
+
+    Parameters:
+        mode: name from DECODE_MODES.
+        flags: combination of TJFLAG_* added to the mode flags.
+
+    Returns:
+        JPEG.default_flags if both mode and flags are None.
+    """
+    if mode is None and flags is None:
+        return JPEG.default_flags
+    if mode is not None and mode not in DECODE_MODES:
+        raise ValueError("mode should be one of %s" %
+                         ", ".join(sorted(DECODE_MODES)))
+    return DECODE_MODES.get(mode, 0) | (flags or 0)
 
 
 class JPEGRuntimeError(RuntimeError):
@@ -93,45 +167,481 @@ class Handle(Base):
             self.handle_ = None
 
 
+class _SlotOwner(object):
+    """Lives in the thread local storage, used to detect thread exit.
+    """
+    pass
+
+
+class HandlePool(object):
+    """Thread-safe bounded pool of tjhandle objects.
+
+    Each thread keeps one idle handle in its thread local slot which is
+    accessed without locking, other idle handles are kept in the shared list
+    bounded by max_size, handles returned to the full pool are destroyed.
+    Handle from the slot of the exited thread is moved to the shared list.
+
+    Attributes:
+        init_name: name of the library function which creates the handle.
+        max_size: maximum number of idle handles in the shared list.
+        hits: number of acquire() calls served from the shared list
+              and from the slots of the exited threads.
+        misses: number of acquire() calls which created a new handle.
+        created: number of created handles.
+        destroyed: number of destroyed handles.
+    """
+    def __init__(self, init_name, max_size=32):
+        self.init_name = init_name
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.destroyed = 0
+        self._lock = threading.RLock()
+        self._handles = []
+        self._slots = {}
+        self._slot_hits = {}
+        self._local = threading.local()
+
+    def _get_slot(self):
+        slot = getattr(self._local, "slot", None)
+        if slot is None:
+            slot = []
+            owner = _SlotOwner()
+            self._local.slot = slot
+            self._local.owner = owner
+            with self._lock:
+                self._slots[id(slot)] = slot
+                self._slot_hits[id(slot)] = 0
+            weakref.finalize(owner, self._reclaim, slot)
+        return slot
+
+    def _reclaim(self, slot):
+        """Moves handle from the slot of the exited thread
+        to the shared list.
+        """
+        handles = []
+        with self._lock:
+            self._slots.pop(id(slot), None)
+            self.hits += self._slot_hits.pop(id(slot), 0)
+            while slot:
+                handle = slot.pop()
+                if len(self._handles) < self.max_size:
+                    self._handles.append(handle)
+                else:
+                    self.destroyed += 1
+                    handles.append(handle)
+        for handle in handles:
+            handle.release()
+
+    def acquire(self, lib_):
+        """Returns idle handle from the pool or creates a new one.
+        """
+        slot = self._get_slot()
+        if slot:
+            try:
+                handle = slot.pop()
+                # only the owning thread writes its counter
+                self._slot_hits[id(slot)] += 1
+                return handle
+            except IndexError:  # taken by concurrent clear()
+                pass
+        with self._lock:
+            if self._handles:
+                self.hits += 1
+                return self._handles.pop()
+            self.misses += 1
+        t0 = metrics.start()
+        h = getattr(lib_, self.init_name)()
+        if t0 is not None:
+            metrics.record(self.init_name, t0,
+                           error=int(h == jpeg.ffi.NULL))
+        if h == jpeg.ffi.NULL:
+            raise JPEGRuntimeError(
+                "%s() failed with error string %s" %
+                (self.init_name, Base(lib_).get_last_error()), 0)
+        with self._lock:
+            self.created += 1
+        return Handle(h, lib_)
+
+    def release(self, handle):
+        """Returns handle to the pool or destroys it if the pool is full.
+        """
+        slot = self._get_slot()
+        if not slot:
+            slot.append(handle)
+            return
+        with self._lock:
+            if len(self._handles) < self.max_size:
+                self._handles.append(handle)
+                return
+            self.destroyed += 1
+        handle.release()
+
+    def clear(self):
+        """Destroys all idle handles including ones in thread local slots.
+        """
+        handles = []
+        with self._lock:
+            handles.extend(self._handles)
+            del self._handles[:]
+            for slot in self._slots.values():
+                try:
+                    handles.append(slot.pop())
+                except IndexError:
+                    pass
+            self.destroyed += len(handles)
+        for handle in reversed(handles):
+            handle.release()
+
+    def reset(self):
+        """Forgets all idle handles without destroying them and resets
+        the counters, used in the child process after fork().
+        """
+        self.__init__(self.init_name, self.max_size)
+
+    def stats(self):
+        """Returns dictionary with the pool counters.
+        """
+        with self._lock:
+            return {"hits": self.hits + sum(self._slot_hits.values()),
+                    "misses": self.misses, "created": self.created,
+                    "destroyed": self.destroyed, "idle": len(self)}
+
+    def __len__(self):
+        """Returns number of idle handles.
+        """
+        with self._lock:
+            return len(self._handles) + sum(
+                len(slot) for slot in self._slots.values())
+
+
+class _Lease(object):
+    """Owner of the buffer leased from BufferArena: arrays are created
+    over it through __array_interface__, so it is the base of every
+    view derived from them and lives while any of them does.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.__array_interface__ = {
+            "shape": buf.shape, "typestr": buf.dtype.str,
+            "data": (buf.__array_interface__["data"][0], False),
+            "version": 3}
+
+
+class BufferArena(object):
+    """Pool of uint8 buffers grouped by size classes (powers of two)
+    to be used for decode() output instead of fresh allocations.
+
+    Buffers are returned to the arena either explicitly with release()
+    or when the array obtained from get() and all the views derived
+    from it are garbage collected.
+    Idle buffers exceeding max_bytes are evicted, oldest first.
+
+    Attributes:
+        max_bytes: maximum total size of idle buffers.
+        alignment: alignment of the buffers in bytes.
+        hugepages: allocate buffers with mmap and advise transparent
+                   huge pages where supported.
+        hits: number of get() calls served from the idle buffers.
+        misses: number of get() calls which allocated a new buffer.
+        evicted: number of evicted buffers.
+    """
+    def __init__(self, max_bytes=256 << 20, alignment=4096,
+                 hugepages=False):
+        self.max_bytes = max_bytes
+        self.alignment = alignment
+        self.hugepages = hugepages
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._idle = collections.OrderedDict()
+        self._classes = {}
+        self._idle_bytes = 0
+        self._leased = {}
+
+    @staticmethod
+    def size_class(nbytes):
+        """Returns the buffer size used to hold nbytes.
+        """
+        size = 4096
+        while size < nbytes:
+            size <<= 1
+        return size
+
+    def _allocate(self, size):
+        if self.hugepages:
+            buf = mmap.mmap(-1, size)
+            if hasattr(buf, "madvise") and hasattr(mmap, "MADV_HUGEPAGE"):
+                buf.madvise(mmap.MADV_HUGEPAGE)
+            return numpy.frombuffer(buf, dtype=numpy.uint8)
+        raw = numpy.empty(size + self.alignment, dtype=numpy.uint8)
+        offs = -raw.__array_interface__["data"][0] % self.alignment
+        return raw[offs:offs + size]
+
+    def get(self, shape):
+        """Returns uninitialized uint8 array of the specified shape.
+        """
+        nbytes = int(numpy.prod(shape))
+        size = self.size_class(nbytes)
+        buf = None
+        with self._lock:
+            keys = self._classes.get(size)
+            if keys:
+                buf = self._idle.pop(keys.pop())
+                self._idle_bytes -= size
+                self.hits += 1
+            else:
+                self.misses += 1
+        if buf is None:
+            buf = self._allocate(size)
+        lease = _Lease(buf)
+        array = numpy.asarray(lease)[:nbytes].reshape(shape)
+        with self._lock:
+            self._leased[id(lease)] = weakref.finalize(
+                lease, self._put, buf, id(lease))
+        return array
+
+    def _put(self, buf, key):
+        with self._lock:
+            self._leased.pop(key, None)
+            self._idle[id(buf)] = buf
+            self._classes.setdefault(buf.nbytes, []).append(id(buf))
+            self._idle_bytes += buf.nbytes
+            while self._idle_bytes > self.max_bytes:
+                key, old = self._idle.popitem(last=False)
+                self._classes[old.nbytes].remove(key)
+                self._idle_bytes -= old.nbytes
+                self.evicted += 1
+
+    def release(self, array):
+        """Returns the buffer of array obtained from get() to the arena,
+        array and the views derived from it must not be used afterwards.
+        """
+        lease = array
+        while isinstance(lease, numpy.ndarray):
+            lease = lease.base
+        with self._lock:
+            finalizer = self._leased.get(id(lease))
+        if finalizer is None or not finalizer.alive:
+            raise ValueError("array was not obtained from this arena "
+                             "or was already released")
+        finalizer()
+
+    @contextlib.contextmanager
+    def released(self, array):
+        """Context manager which yields array and releases it on exit.
+        """
+        try:
+            yield array
+        finally:
+            self.release(array)
+
+    def clear(self):
+        """Drops all idle buffers.
+        """
+        with self._lock:
+            self._idle.clear()
+            self._classes.clear()
+            self._idle_bytes = 0
+
+    def stats(self):
+        """Returns dictionary with the arena counters.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "evicted": self.evicted, "idle": len(self._idle),
+                    "idle_bytes": self._idle_bytes,
+                    "leased": len(self._leased)}
+
+
+class DecodeCache(object):
+    """LRU cache of decoded images keyed by the hash of the compressed
+    data and the decoding parameters.
+
+    The cached arrays are read-only and returned as they are.
+
+    Attributes:
+        max_bytes: maximum total size of the cached images.
+        hits: number of lookups served from the cache.
+        misses: number of lookups which decoded the image.
+        evicted: number of evicted images.
+    """
+    def __init__(self, max_bytes=256 << 20):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._images = collections.OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def key(source, pixfmt, scale, max_size, region, flags):
+        """Returns the cache key of decoding the compressed source
+        (contiguous buffer) with the specified parameters.
+        """
+        def freeze(value):
+            return tuple(value) if isinstance(value, (list, tuple)) else value
+
+        return (hashlib.blake2b(source, digest_size=16).digest(), pixfmt,
+                freeze(scale), freeze(max_size), freeze(region), flags)
+
+    def get(self, key):
+        """Returns the cached image or None.
+        """
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        """Caches image (makes it read-only), images larger than max_bytes
+        are not cached (and left writeable).
+        """
+        if image.nbytes > self.max_bytes:
+            return
+        image.flags.writeable = False
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._images[key] = image
+            self._bytes += image.nbytes
+            while self._bytes > self.max_bytes:
+                _key, old = self._images.popitem(last=False)
+                self._bytes -= old.nbytes
+                self.evicted += 1
+
+    def decode(self, jp, pixfmt=TJPF_RGB, scale=None, max_size=None,
+               region=None, mode=None, flags=None):
+        """Returns the cached result of jp.decode() with the specified
+        parameters, decoding and caching it on a miss.
+        """
+        flags = decode_flags(mode, flags)
+        key = self.key(jp.source, pixfmt, scale, max_size, region, flags)
+        image = self.get(key)
+        if image is None:
+            image = jp.decode(pixfmt=pixfmt, scale=scale, max_size=max_size,
+                              region=region, flags=flags, cache=False)
+            self.put(key, image)
+        return image
+
+    def clear(self):
+        """Drops all cached images.
+        """
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Returns dictionary with the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evicted": self.evicted, "images": len(self._images),
+                    "bytes": self._bytes}
+
+    def __len__(self):
+        return len(self._images)
+
+
 class JPEG(Base):
     """Main class.
 
     Attributes:
         decompressor: Handle object for decompressor.
+        compressor: Handle object for compressor.
+        transformer: Handle object for transformer.
         source: numpy array with source data,
                 either encoded raw jpeg which may be decoded/transformed or
                 or source image for the later encode.
         width: image width.
         height: image height.
         subsampling: level of chrominance subsampling.
+        precision: bits per sample (8, 12 or 16), images with
+                   more than 8 bits are decoded to uint16 arrays.
+        lossless: whether the image is lossless JPEG.
+        progressive: whether the image is progressive JPEG
+                     (None without TurboJPEG 3 API).
+        scaling_factor: (num, denom) scaling factor selected in
+                        parse_header().
+        scaled_width: image width after scaling.
+        scaled_height: image height after scaling.
 
     Static attributes:
-        decompressors: list of decompressors for caching purposes.
+        decompressors: HandlePool of decompressors.
+        compressors: HandlePool of compressors.
+        transformers: HandlePool of transformers.
+        scaling_factors: library to supported scaling factors mapping.
+        buffers: thread local storage for reusable encode buffers.
+        arena: BufferArena used by decode() by default or None.
+        cache: DecodeCache used by decode() by default or None.
+        default_flags: flags used by the decoding methods
+                       when neither mode nor flags are given.
     """
-    decompressors = []
+    decompressors = HandlePool("tjInitDecompress")
+    compressors = HandlePool("tjInitCompress")
+    transformers = HandlePool("tjInitTransform")
+    scaling_factors = {}
+    buffers = threading.local()
+    arena = None
+    cache = None
+    default_flags = 0
 
     @staticmethod
     def clear():
         """Clears internal caches.
         """
-        # Manually release cached JPEG decompressors
-        for handle in reversed(JPEG.decompressors):
-            handle.release()
-        del JPEG.decompressors[:]
+        JPEG.decompressors.clear()
+        JPEG.compressors.clear()
+        JPEG.transformers.clear()
 
-    def __init__(self, source, lib_=None):
+    @staticmethod
+    def stats():
+        """Returns dictionary with handle pools counters.
+        """
+        return {"decompressors": JPEG.decompressors.stats(),
+                "compressors": JPEG.compressors.stats(),
+                "transformers": JPEG.transformers.stats()}
+
+    def __init__(self, source, lib_=None, mmap=False):
         """Constructor.
 
         Parameters:
-            source: source for JPEG operations (numpy array or file name).
+            source: source for JPEG operations: numpy array,
+                    object supporting buffer protocol
+                    (bytes, bytearray, memoryview, etc.), used without copy,
+                    or file name.
+            mmap: memory-map the file instead of reading it into memory.
         """
-        super(JPEG, self).__init__(lib_)
         self.decompressor = None
+        self.compressor = None
+        self.transformer = None
+        super(JPEG, self).__init__(lib_)
         self.width = None
         self.height = None
         self.subsampling = None
+        self.precision = None
+        self.lossless = None
+        self.progressive = None
+        self.scaling_factor = None
+        self.scaled_width = None
+        self.scaled_height = None
         if hasattr(source, "__array_interface__"):
             self.source = source
+        elif not isinstance(source, str) and not hasattr(source,
+                                                         "__fspath__"):
+            self.source = numpy.frombuffer(source, dtype=numpy.uint8)
+        elif mmap:
+            self.source = numpy.memmap(source, dtype=numpy.uint8, mode="r")
         elif numpy.fromfile is not None:
             self.source = numpy.fromfile(source, dtype=numpy.uint8)
         else:
@@ -142,60 +652,237 @@ class JPEG(Base):
             fin.close()
 
     def _get_decompressor(self):
-        if self.decompressor is not None:
-            return
-        try:
-            self.decompressor = JPEG.decompressors.pop(-1)
-        except IndexError:
-            d = self.lib_.tjInitDecompress()
-            if d == jpeg.ffi.NULL:
-                raise JPEGRuntimeError(
-                    "tjInitDecompress() failed with error "
-                    "string %s" % self.get_last_error(), 0)
-            self.decompressor = Handle(d, self.lib_)
-
-    def parse_header(self):
+        if self.decompressor is None:
+            self.decompressor = JPEG.decompressors.acquire(self.lib_)
+
+    def _has_tj3(self):
+        if self.lib_ is jpeg.lib:
+            return jpeg.tj3
+        return hasattr(self.lib_, "tj3Init")
+
+    def _get_compressor(self):
+        if self.compressor is None:
+            self.compressor = JPEG.compressors.acquire(self.lib_)
+
+    def _get_transformer(self):
+        if self.transformer is None:
+            self.transformer = JPEG.transformers.acquire(self.lib_)
+
+    def get_scaling_factors(self):
+        """Returns list of (num, denom) scaling factors supported by the
+        library sorted in descending order.
+        """
+        factors = JPEG.scaling_factors.get(self.lib_)
+        if factors is not None:
+            return factors
+        n = jpeg.ffi.new("int*")
+        sf = self.lib_.tjGetScalingFactors(n)
+        if sf == jpeg.ffi.NULL:
+            raise JPEGRuntimeError("tjGetScalingFactors() failed with error "
+                                   "string %s" % self.get_last_error(), 0)
+        factors = sorted(((int(sf[i].num), int(sf[i].denom))
+                          for i in range(n[0])),
+                         key=lambda f: float(f[0]) / f[1], reverse=True)
+        JPEG.scaling_factors[self.lib_] = factors
+        return factors
+
+    def get_scaling_factor(self, scale=None, max_size=None, min_size=None):
+        """Selects the scaling factor supported by the library.
+
+        Parameters:
+            scale: desired scale (float or (num, denom) tuple),
+                   the nearest supported factor will be selected.
+            max_size: maximum output size (int or (width, height) tuple),
+                      the largest supported factor not above 1/1
+                      fitting into it (or the smallest one if none fits)
+                      will be selected.
+            min_size: minimum output size (int or (width, height) tuple),
+                      the smallest supported factor covering it
+                      (or 1/1 if none covers) will be selected.
+
+        Returns:
+            (num, denom) tuple.
+        """
+        if scale is None and max_size is None and min_size is None:
+            return 1, 1
+        factors = self.get_scaling_factors()
+        if scale is not None:
+            if isinstance(scale, tuple):
+                scale = float(scale[0]) / scale[1]
+            return min(factors,
+                       key=lambda f: abs(float(f[0]) / f[1] - scale))
+        if self.width is None:
+            self.parse_header()
+        if max_size is not None:
+            if not isinstance(max_size, tuple):
+                max_size = (max_size, max_size)
+            for f in factors:
+                if (f[0] <= f[1] and
+                        tjscaled(self.width, f) <= max_size[0] and
+                        tjscaled(self.height, f) <= max_size[1]):
+                    return f
+            return factors[-1]
+        if not isinstance(min_size, tuple):
+            min_size = (min_size, min_size)
+        for f in reversed(factors):
+            if (f[0] <= f[1] and tjscaled(self.width, f) >= min_size[0] and
+                    tjscaled(self.height, f) >= min_size[1]):
+                return f
+        return 1, 1
+
+    def parse_header(self, scale=None, max_size=None):
         """Parses JPEG header.
 
-        Fills self.width, self.height, self.subsampling.
+        Fills self.width, self.height, self.subsampling, self.precision,
+        self.lossless, self.progressive, self.scaled_width, self.scaled_height,
+        self.scaling_factor.
+
+        Parameters:
+            scale: desired scale (see get_scaling_factor()).
+            max_size: maximum output size (see get_scaling_factor()).
         """
         self._get_decompressor()
-        whs = jpeg.ffi.new("int[]", 3)
-        whs_base = int(jpeg.ffi.cast("size_t", whs))
-        whs_itemsize = int(jpeg.ffi.sizeof("int"))
-        n = self.lib_.tjDecompressHeader2(
-            self.decompressor.handle_,
-            jpeg.ffi.cast("unsigned char*",
-                          self.source.__array_interface__["data"][0]),
-            self.source.nbytes,
-            jpeg.ffi.cast("int*", whs_base),
-            jpeg.ffi.cast("int*", whs_base + whs_itemsize),
-            jpeg.ffi.cast("int*", whs_base + whs_itemsize + whs_itemsize))
+        helper = getattr(self.lib_, "jpeg4py_decompress_header", None)
+        t0 = metrics.start()
+        if helper is not None:
+            whs = helper(self.decompressor.handle_,
+                         self.source.__array_interface__["data"][0],
+                         self.source.nbytes)
+            n = -1 if whs < 0 else 0
+        else:
+            whs = jpeg.ffi.new("int[]", 3)
+            whs_base = int(jpeg.ffi.cast("size_t", whs))
+            whs_itemsize = int(jpeg.ffi.sizeof("int"))
+            n = self.lib_.tjDecompressHeader2(
+                self.decompressor.handle_,
+                jpeg.ffi.cast("unsigned char*",
+                              self.source.__array_interface__["data"][0]),
+                self.source.nbytes,
+                jpeg.ffi.cast("int*", whs_base),
+                jpeg.ffi.cast("int*", whs_base + whs_itemsize),
+                jpeg.ffi.cast("int*",
+                              whs_base + whs_itemsize + whs_itemsize))
+        if t0 is not None:
+            metrics.record("tjDecompressHeader2", t0, self.source.nbytes,
+                           error=n)
         if n:
             raise JPEGRuntimeError("tjDecompressHeader2() failed with error "
                                    "%d and error string %s" %
                                    (n, self.get_last_error()), n)
-        self.width = int(whs[0])
-        self.height = int(whs[1])
-        self.subsampling = int(whs[2])
+        if helper is not None:
+            self.width = whs >> 32
+            self.height = (whs >> 8) & 0xFFFFFF
+            self.subsampling = ((whs & 0xFF) ^ 0x80) - 0x80
+        else:
+            self.width = int(whs[0])
+            self.height = int(whs[1])
+            self.subsampling = int(whs[2])
+        if self._has_tj3():
+            handle = self.decompressor.handle_
+            self.precision = self.lib_.tj3Get(handle, TJPARAM_PRECISION)
+            self.lossless = bool(self.lib_.tj3Get(handle, TJPARAM_LOSSLESS))
+            self.progressive = bool(
+                self.lib_.tj3Get(handle, TJPARAM_PROGRESSIVE))
+        else:
+            self.precision = 8
+            self.lossless = False
+        self.scaling_factor = self.get_scaling_factor(scale, max_size)
+        self.scaled_width = tjscaled(self.width, self.scaling_factor)
+        self.scaled_height = tjscaled(self.height, self.scaling_factor)
 
-    def decode(self, dst=None, pixfmt=TJPF_RGB):
+    def decode(self, dst=None, pixfmt=TJPF_RGB, scale=None, max_size=None,
+               region=None, arena=None, mode=None, flags=None, cache=None,
+               on_error="raise"):
+        """Decodes JPEG.
+
+        Parameters:
+            dst: numpy array to decode to or None to allocate a new one,
+                 if scale and max_size are None, the image will be scaled
+                 to the largest supported size fitting dst.
+            pixfmt: pixel format of the output.
+            scale: desired scale (see get_scaling_factor()).
+            max_size: maximum output size (see get_scaling_factor()).
+            region: (x, y, width, height) window to decode,
+                    only the MCU blocks covering it are decompressed,
+                    cannot be combined with scale and max_size.
+            arena: BufferArena to take dst from if it is None
+                   (defaults to JPEG.arena).
+            mode: speed/accuracy trade-off from DECODE_MODES.
+            flags: TJFLAG_* flags (see decode_flags()).
+            cache: DecodeCache to serve the result from if dst is None
+                   (defaults to JPEG.cache), the result is then read-only,
+                   False to bypass JPEG.cache.
+            on_error: what to do when the data is truncated or corrupt:
+                      "raise" - raise JPEGRuntimeError,
+                      "skip" - return None,
+                      "partial" - return (image, complete) tuple, where
+                      image holds the rows decoded before the error
+                      (found with TurboJPEG 3 API cropping, no rows
+                      for progressive images or without it)
+                      or is None if the header is unreadable.
+
+        Returns:
+            dst or its top-left part holding the scaled image or the region.
+        """
+        if on_error != "raise":
+            return self._decode_on_error(on_error, dst, pixfmt, scale,
+                                         max_size, region, arena, mode,
+                                         flags, cache)
+        if cache is None:
+            cache = JPEG.cache
+        elif cache is False:
+            cache = None
+        if cache is not None and dst is None:
+            return cache.decode(self, pixfmt, scale, max_size, region,
+                                mode, flags)
+        if region is not None:
+            if scale is not None or max_size is not None:
+                raise ValueError(
+                    "region cannot be combined with scale or max_size")
+            return self._decode_region(region, dst, pixfmt,
+                                       decode_flags(mode, flags))
         bpp = jpeg.tjPixelSize[pixfmt]
-        if dst is None:
+        if dst is not None and not hasattr(dst, "__array_interface__"):
+            raise ValueError("dst should be numpy array or None")
+        if dst is None or scale is not None or max_size is not None:
             if self.width is None:
                 self.parse_header()
-            sh = [self.height, self.width]
+            f = self.get_scaling_factor(scale, max_size)
+            width = tjscaled(self.width, f)
+            height = tjscaled(self.height, f)
+        if dst is None:
+            sh = [height, width]
             if bpp > 1:
                 sh.append(bpp)
-            dst = numpy.zeros(sh, dtype=numpy.uint8)
-        elif not hasattr(dst, "__array_interface__"):
-            raise ValueError("dst should be numpy array or None")
+            arena = arena or JPEG.arena
+            t0 = metrics.start()
+            if self.precision > 8:
+                dst = numpy.empty(sh, dtype=numpy.uint16)
+            elif arena is not None:
+                dst = arena.get(sh)
+            else:
+                dst = numpy.empty(sh, dtype=numpy.uint8)
+            if t0 is not None:
+                metrics.record("alloc", t0)
         if len(dst.shape) < 2:
             raise ValueError("dst shape length should 2 or 3")
-        if dst.nbytes < dst.shape[1] * dst.shape[0] * bpp:
+        if scale is None and max_size is None:
+            width = dst.shape[1]
+            height = dst.shape[0]
+        elif dst.shape[0] < height or dst.shape[1] < width:
+            raise ValueError("dst is too small to hold the scaled image")
+        elif dst.shape[0] != height or dst.shape[1] != width:
+            dst = dst[:height, :width]
+        if dst.nbytes < dst.shape[1] * dst.shape[0] * bpp * dst.itemsize:
             raise ValueError(
                 "dst is too small to hold the requested pixel format")
+        if dst.itemsize > 1 or (self.precision or 8) > 8:
+            if scale is None and max_size is None:
+                f = self.get_scaling_factor(max_size=(width, height))
+            self._decompress3(dst, pixfmt, decode_flags(mode, flags), f)
+            return dst
         self._get_decompressor()
+        t0 = metrics.start()
         n = self.lib_.tjDecompress2(
             self.decompressor.handle_,
             jpeg.ffi.cast("unsigned char*",
@@ -203,14 +890,931 @@ class JPEG(Base):
             self.source.nbytes,
             jpeg.ffi.cast("unsigned char*",
                           dst.__array_interface__["data"][0]),
-            dst.shape[1], dst.strides[0], dst.shape[0], pixfmt, 0)
+            width, dst.strides[0], height, pixfmt, decode_flags(mode, flags))
+        if t0 is not None:
+            metrics.record("tjDecompress2", t0, self.source.nbytes,
+                           width * height, n)
         if n:
             raise JPEGRuntimeError("tjDecompress2() failed with error "
                                    "%d and error string %s" %
                                    (n, self.get_last_error()), n)
         return dst
 
-    def __del__(self):
-        # Return decompressor to cache.
+    def _decode_on_error(self, on_error, dst, pixfmt, scale, max_size,
+                         region, arena, mode, flags, cache):
+        """Implements decode() with on_error other than "raise".
+        """
+        if on_error not in ("partial", "skip"):
+            raise ValueError("on_error should be one of "
+                             "\"raise\", \"partial\", \"skip\"")
+        if on_error == "partial" and region is not None:
+            raise ValueError(
+                "on_error=\"partial\" cannot be combined with region")
+        try:
+            image = self.decode(dst, pixfmt, scale, max_size, region, arena,
+                                mode, flags, cache)
+        except JPEGRuntimeError:
+            if on_error == "skip":
+                return None
+            return (self._decode_partial(dst, pixfmt, scale, max_size,
+                                         decode_flags(mode, flags)), False)
+        return image if on_error == "skip" else (image, True)
+
+    def _decode_partial(self, dst, pixfmt, scale, max_size, flags):
+        """Returns the rows which decode without errors.
+
+        Cropping regions ending at the row are decoded in binary search
+        over the scaled MCU rows: every probe decodes from the top,
+        so the rows above the error are left intact by the failing ones.
+        """
+        try:
+            if self.width is None:
+                self.parse_header()
+        except JPEGRuntimeError:
+            return None
+        if dst is not None and scale is None and max_size is None:
+            f = self.get_scaling_factor(max_size=(dst.shape[1],
+                                                  dst.shape[0]))
+        else:
+            f = self.get_scaling_factor(scale, max_size)
+        width = tjscaled(self.width, f)
+        height = tjscaled(self.height, f)
+        if dst is None:
+            bpp = jpeg.tjPixelSize[pixfmt]
+            sh = [height, width]
+            if bpp > 1:
+                sh.append(bpp)
+            dst = numpy.empty(sh, dtype=numpy.uint16 if self.precision > 8
+                              else numpy.uint8)
+        else:
+            dst = dst[:height, :width]
+        step = max(1, tjscaled(jpeg.tjMCUHeight.get(self.subsampling, 8), f))
+        good, bad = 0, height
+        if self._has_tj3() and not self.progressive:
+            while bad - good > step:
+                rows = (good + bad) // 2
+                rows = max(rows - rows % step, good + step)
+                try:
+                    self._decompress3(dst[:rows], pixfmt, flags, f,
+                                      (0, 0, width, rows))
+                    good = rows
+                except JPEGRuntimeError:
+                    bad = rows
+        return dst[:good]
+
+    def _decompress3(self, dst, pixfmt, flags, scaling_factor=(1, 1),
+                     region=None):
+        """Decompresses to dst with TurboJPEG 3 API.
+
+        Parameters:
+            dst: numpy uint8 array for 8-bit images or uint16 otherwise.
+            pixfmt: pixel format of the output.
+            flags: TJFLAG_* flags.
+            scaling_factor: (num, denom) scaling factor.
+            region: (x, y, width, height) cropping region in the scaled
+                    image, x should be aligned to the scaled MCU width.
+        """
+        if not self._has_tj3():
+            raise JPEGRuntimeError("TurboJPEG 3 API is not available", 0)
+        if self.precision is None:
+            self.parse_header()
+        if self.precision <= 8:
+            name, ctype, dtype = "tj3Decompress8", "unsigned char*", "uint8"
+        elif self.precision <= 12:
+            name, ctype, dtype = "tj3Decompress12", "short*", "uint16"
+        else:
+            name, ctype, dtype = ("tj3Decompress16", "unsigned short*",
+                                  "uint16")
+        if dst.dtype != dtype:
+            raise ValueError("dst should be of %s dtype for %d-bit image" %
+                             (dtype, self.precision))
+        self._get_decompressor()
+        lib_ = self.lib_
+        handle = self.decompressor.handle_
+        for param, flag in ((TJPARAM_FASTUPSAMPLE, TJFLAG_FASTUPSAMPLE),
+                            (TJPARAM_FASTDCT, TJFLAG_FASTDCT),
+                            (TJPARAM_BOTTOMUP, TJFLAG_BOTTOMUP)):
+            lib_.tj3Set(handle, param, 1 if flags & flag else 0)
+        src = jpeg.ffi.cast("unsigned char*",
+                            self.source.__array_interface__["data"][0])
+        t0 = metrics.start()
+        try:
+            # Scaling and cropping are validated against the header
+            # read by the handle, which may differ from parse_header() one
+            n = lib_.tj3DecompressHeader(handle, src, self.source.nbytes)
+            if not n:
+                n = lib_.tj3SetScalingFactor(handle, scaling_factor)
+            if not n and region is not None:
+                n = lib_.tj3SetCroppingRegion(handle, region)
+            if not n:
+                n = getattr(lib_, name)(
+                    handle, src, self.source.nbytes,
+                    jpeg.ffi.cast(ctype, dst.__array_interface__["data"][0]),
+                    dst.strides[0] // dst.itemsize, pixfmt)
+        finally:
+            # Both stick to the pooled handle
+            if region is not None:
+                lib_.tj3SetCroppingRegion(handle, (0, 0, 0, 0))
+            lib_.tj3SetScalingFactor(handle, (1, 1))
+        if t0 is not None:
+            metrics.record(name, t0, self.source.nbytes,
+                           dst.shape[0] * dst.shape[1], n)
+        if n:
+            raise JPEGRuntimeError("%s() failed with error %d and error "
+                                   "string %s" %
+                                   (name, n, self.get_last_error()), n)
+
+    def _decode_region(self, region, dst, pixfmt, flags):
+        x, y, width, height = region
+        if self.width is None:
+            self.parse_header()
+        if (x < 0 or y < 0 or width <= 0 or height <= 0 or
+                x + width > self.width or y + height > self.height):
+            raise ValueError("region is out of the image bounds")
+        mcu_w = jpeg.tjMCUWidth.get(self.subsampling)
+        mcu_h = jpeg.tjMCUHeight.get(self.subsampling)
+        if mcu_w is None or (x < mcu_w and y < mcu_h and
+                             width + x == self.width and
+                             height + y == self.height):
+            a = self.decode(pixfmt=pixfmt, flags=flags)[
+                y:y + height, x:x + width]
+        elif self._has_tj3():
+            x0 = x - x % mcu_w
+            bpp = jpeg.tjPixelSize[pixfmt]
+            sh = [height, x + width - x0]
+            if bpp > 1:
+                sh.append(bpp)
+            a = numpy.empty(sh, dtype=numpy.uint16 if self.precision > 8
+                            else numpy.uint8)
+            self._decompress3(a, pixfmt, flags,
+                              region=(x0, y, sh[1], height))
+            a = a[:, x - x0:]
+        else:
+            # Lossless crop to the MCU aligned window, then decode it
+            x0, y0 = x - x % mcu_w, y - y % mcu_h
+            cropped = JPEG(self.transform(
+                crop=(x0, y0, x + width - x0, y + height - y0)), self.lib_)
+            with cropped:
+                a = cropped.decode(pixfmt=pixfmt, flags=flags)[
+                    y - y0:, x - x0:]
+        if dst is None:
+            return a
+        if not hasattr(dst, "__array_interface__"):
+            raise ValueError("dst should be numpy array or None")
+        if dst.shape[0] < height or dst.shape[1] < width:
+            raise ValueError("dst is too small to hold the region")
+        dst = dst[:height, :width]
+        dst[...] = a.reshape(dst.shape)
+        return dst
+
+    def decode_strips(self, rows=64, pixfmt=TJPF_RGB, mode=None,
+                      flags=None):
+        """Decodes JPEG in horizontal bands into a reused buffer.
+
+        The bands are cut losslessly from the compressed data
+        in a single transform call together with one MCU row above
+        and below for upsampling context, then decoded one at a time,
+        so the decoded pixels held at once are bounded by the band size
+        and the total time is linear in the image height
+        (TurboJPEG 3 cropping is not used: each cropped decode starts
+        from the top of the image).
+
+        Parameters:
+            rows: band height, rounded up to a multiple of the MCU height.
+            pixfmt: pixel format of the output.
+            mode: speed/accuracy trade-off from DECODE_MODES.
+            flags: TJFLAG_* flags (see decode_flags()).
+
+        Returns:
+            iterator of (y, band) where band is a view of the buffer
+            valid until the next band is requested.
+        """
+        if rows <= 0:
+            raise ValueError("rows should be positive")
+        if self.width is None:
+            self.parse_header()
+        flags = decode_flags(mode, flags)
+        mcu_h = jpeg.tjMCUHeight.get(self.subsampling)
+        if mcu_h is None:
+            # Unknown MCU layout: cannot cut, so slice the whole image
+            a = self.decode(pixfmt=pixfmt, flags=flags)
+            return ((y, a[y:y + rows]) for y in range(0, self.height, rows))
+        rows = -(-rows // mcu_h) * mcu_h
+        if rows >= self.height:
+            return iter(((0, self.decode(pixfmt=pixfmt, flags=flags)),))
+        windows = []
+        for y in range(0, self.height, rows):
+            y0 = max(y - mcu_h, 0)
+            y1 = min(y + rows + mcu_h, self.height)
+            windows.append((y, min(rows, self.height - y), y0, y1 - y0))
+        bands = self.transform_many([dict(
+            crop=(0, y0, 0, h0), copy_none=True)
+            for _y, _h, y0, h0 in windows])
+        bpp = jpeg.tjPixelSize[pixfmt]
+        sh = [rows + 2 * mcu_h, self.width]
+        if bpp > 1:
+            sh.append(bpp)
+        buf = numpy.empty(sh, dtype=numpy.uint16 if self.precision > 8
+                          else numpy.uint8)
+        return self._iter_strips(windows, bands, buf, pixfmt, flags)
+
+    def _iter_strips(self, windows, bands, buf, pixfmt, flags):
+        for i, (y, height, y0, h0) in enumerate(windows):
+            band = JPEG(bands[i], self.lib_)
+            bands[i] = None
+            with band:
+                band.decode(buf[:h0], pixfmt, flags=flags)
+            yield y, buf[y - y0:y - y0 + height]
+
+    def decode_tensor(self, layout="CHW", dtype=numpy.float32, mean=None,
+                      std=None, out=None, pixfmt=TJPF_RGB, scale=None,
+                      max_size=None, mode=None, flags=None):
+        """Decodes JPEG to normalized floating point tensor.
+
+        The image is decoded to the thread local scratch buffer, then
+        (pixel - mean) / std is written to out in the requested layout
+        in blocks of rows fitting into the cache.
+
+        Parameters:
+            layout: "CHW" or "HWC".
+            dtype: floating point dtype of the output if out is None.
+            mean: scalar or per channel value to subtract (in pixel units).
+            std: scalar or per channel value to divide by (in pixel units).
+            out: numpy floating point array of the output shape or None
+                 to allocate one.
+            pixfmt: pixel format of the decoded image.
+            scale: desired scale (see get_scaling_factor()).
+            max_size: maximum output size (see get_scaling_factor()).
+            mode: speed/accuracy trade-off from DECODE_MODES.
+            flags: TJFLAG_* flags (see decode_flags()).
+
+        Returns:
+            out.
+        """
+        if self.width is None:
+            self.parse_header()
+        f = self.get_scaling_factor(scale, max_size)
+        sh = (tjscaled(self.height, f), tjscaled(self.width, f),
+              jpeg.tjPixelSize[pixfmt])
+        src = _scratch(sh, numpy.uint16 if self.precision > 8
+                       else numpy.uint8)
+        self.decode(src, pixfmt, scale=f, mode=mode, flags=flags)
+        return _normalize(src, _tensor_out(out, sh, layout, dtype),
+                          layout, mean, std)
+
+    def decode_yuv(self, dst=None, mode=None, flags=None):
+        """Decodes JPEG to planar YUV skipping color conversion
+        and chrominance upsampling.
+
+        Parameters:
+            dst: numpy uint8 array of at least tjBufSizeYUV() bytes
+                 to decode to or None to allocate a new one.
+            mode: speed/accuracy trade-off from DECODE_MODES.
+            flags: TJFLAG_* flags (see decode_flags()).
+
+        Returns:
+            tuple of Y, U, V planes (only Y for grayscale images)
+            as 2D numpy views over dst, plane shapes are derived from
+            self.subsampling (rows of each plane are padded to 4 bytes).
+        """
+        if self.width is None:
+            self.parse_header()
+        size = int(self.lib_.tjBufSizeYUV(self.width, self.height,
+                                          self.subsampling))
+        if size == int(jpeg.ffi.cast("unsigned long", -1)):
+            raise JPEGRuntimeError("tjBufSizeYUV() failed with error "
+                                   "string %s" % self.get_last_error(), 0)
+        if dst is None:
+            dst = numpy.empty(size, dtype=numpy.uint8)
+        elif not hasattr(dst, "__array_interface__"):
+            raise ValueError("dst should be numpy array or None")
+        elif (dst.nbytes < size or dst.dtype != numpy.uint8 or
+              not dst.flags.c_contiguous):
+            raise ValueError("dst should be contiguous uint8 array of at "
+                             "least tjBufSizeYUV() = %d bytes" % size)
+        buf = dst.reshape(-1)
+        self._get_decompressor()
+        t0 = metrics.start()
+        n = self.lib_.tjDecompressToYUV(
+            self.decompressor.handle_,
+            jpeg.ffi.cast("unsigned char*",
+                          self.source.__array_interface__["data"][0]),
+            self.source.nbytes,
+            jpeg.ffi.cast("unsigned char*",
+                          buf.__array_interface__["data"][0]),
+            decode_flags(mode, flags))
+        if t0 is not None:
+            metrics.record("tjDecompressToYUV", t0, self.source.nbytes,
+                           self.width * self.height, n)
+        if n:
+            raise JPEGRuntimeError("tjDecompressToYUV() failed with error "
+                                   "%d and error string %s" %
+                                   (n, self.get_last_error()), n)
+        planes = []
+        offs = 0
+        for h, w, stride in yuv_planes(self.width, self.height,
+                                       self.subsampling):
+            planes.append(
+                buf[offs:offs + h * stride].reshape(h, stride)[:, :w])
+            offs += h * stride
+        return tuple(planes)
+
+    def encode(self, dst=None, quality=95, subsampling=None, pixfmt=None,
+               lossless=False, precision=None):
+        """Encodes self.source image to JPEG.
+
+        Parameters:
+            dst: numpy uint8 array to write JPEG data to
+                 (should be at least of tjBufSize() size) or None,
+                 in which case JPEG data will be written to the thread local
+                 reusable buffer and then copied to the new array
+                 of the exact size.
+            quality: JPEG quality (1 to 100).
+            subsampling: level of chrominance subsampling, defaults to
+                         TJSAMP_GRAY for grayscale images and
+                         TJSAMP_420 otherwise.
+            pixfmt: pixel format of self.source, defaults to
+                    TJPF_GRAY, TJPF_RGB, TJPF_RGBX for 1, 3, 4 channels.
+            lossless: produce lossless JPEG (quality and subsampling
+                      are ignored, requires TurboJPEG 3 API).
+            precision: bits per sample: 8 for uint8 source (default),
+                       12 (default) or 16 (lossless only) for uint16 source
+                       (requires TurboJPEG 3 API).
+
+        Returns:
+            numpy uint8 array with JPEG data (a view over dst if it was given).
+        """
+        src = self.source
+        if len(src.shape) not in (2, 3) or src.dtype not in (numpy.uint8,
+                                                             numpy.uint16):
+            raise ValueError("source should be uint8 or uint16 array of shape "
+                             "(height, width) or (height, width, channels)")
+        if precision is None:
+            precision = 8 if src.dtype == numpy.uint8 else (
+                16 if lossless else 12)
+        if precision not in ((8,) if src.dtype == numpy.uint8 else (12, 16)):
+            raise ValueError("precision %d does not match %s source" %
+                             (precision, src.dtype))
+        pixfmt, subsampling = self._source_format(pixfmt, subsampling,
+                                                  lossless)
+        if lossless or precision != 8:
+            return self._encode3(dst, quality, subsampling, pixfmt,
+                                 lossless, precision)
+        height, width = src.shape[0], src.shape[1]
+        size = int(self.lib_.tjBufSize(width, height, subsampling))
+        if size == int(jpeg.ffi.cast("unsigned long", -1)):
+            raise JPEGRuntimeError("tjBufSize() failed with error "
+                                   "string %s" % self.get_last_error(), 0)
+        if dst is None:
+            buf = getattr(JPEG.buffers, "encode", None)
+            if buf is None or buf.nbytes < size:
+                buf = numpy.empty(size, dtype=numpy.uint8)
+                JPEG.buffers.encode = buf
+        elif not hasattr(dst, "__array_interface__"):
+            raise ValueError("dst should be numpy array or None")
+        elif (dst.nbytes < size or dst.dtype != numpy.uint8 or
+              not dst.flags.c_contiguous):
+            raise ValueError("dst should be contiguous uint8 array of at "
+                             "least tjBufSize() = %d bytes" % size)
+        else:
+            buf = dst.reshape(-1)
+        self._get_compressor()
+        pbuf = jpeg.ffi.new("unsigned char**", jpeg.ffi.cast(
+            "unsigned char*", buf.__array_interface__["data"][0]))
+        psize = jpeg.ffi.new("unsigned long*", buf.nbytes)
+        t0 = metrics.start()
+        n = self.lib_.tjCompress2(
+            self.compressor.handle_,
+            jpeg.ffi.cast("unsigned char*",
+                          src.__array_interface__["data"][0]),
+            width, src.strides[0], height, pixfmt, pbuf, psize,
+            subsampling, quality, TJFLAG_NOREALLOC)
+        if t0 is not None:
+            metrics.record("tjCompress2", t0, src.nbytes, error=n)
+        if n:
+            raise JPEGRuntimeError("tjCompress2() failed with error "
+                                   "%d and error string %s" %
+                                   (n, self.get_last_error()), n)
+        if dst is None:
+            return buf[:psize[0]].copy()
+        return buf[:psize[0]]
+
+    def _source_format(self, pixfmt, subsampling, lossless=False):
+        """Checks layout of self.source and returns (pixfmt, subsampling)
+        with the defaults of encode() applied.
+        """
+        src = self.source
+        if pixfmt is None:
+            channels = src.shape[2] if len(src.shape) == 3 else 1
+            pixfmt = {1: TJPF_GRAY, 3: TJPF_RGB, 4: TJPF_RGBX}.get(channels)
+            if pixfmt is None:
+                raise ValueError("pixfmt should be given for %d channels" %
+                                 channels)
+        bpp = jpeg.tjPixelSize[pixfmt]
+        if src.strides[1] != bpp * src.itemsize or (
+                len(src.shape) == 3 and src.strides[2] != src.itemsize):
+            raise ValueError("source rows should be contiguous and match "
+                             "the requested pixel format")
+        if subsampling is None:
+            subsampling = TJSAMP_GRAY if pixfmt == TJPF_GRAY else (
+                TJSAMP_444 if lossless else TJSAMP_420)
+        return pixfmt, subsampling
+
+    def _encode3(self, dst, quality, subsampling, pixfmt, lossless,
+                 precision):
+        """Encodes with TurboJPEG 3 API into the buffer allocated
+        by the library.
+        """
+        if not self._has_tj3():
+            raise JPEGRuntimeError("TurboJPEG 3 API is not available", 0)
+        name, ctype = {8: ("tj3Compress8", "unsigned char*"),
+                       12: ("tj3Compress12", "short*"),
+                       16: ("tj3Compress16", "unsigned short*")}[precision]
+        if dst is not None and (not hasattr(dst, "__array_interface__") or
+                                dst.dtype != numpy.uint8 or
+                                not dst.flags.c_contiguous):
+            raise ValueError("dst should be contiguous uint8 array or None")
+        src = self.source
+        self._get_compressor()
+        lib_ = self.lib_
+        handle = self.compressor.handle_
+        pbuf = jpeg.ffi.new("unsigned char**")
+        psize = jpeg.ffi.new("size_t*")
+        try:
+            # tjCompress2() leaves TJFLAG_NOREALLOC set on pooled handles
+            lib_.tj3Set(handle, TJPARAM_NOREALLOC, 0)
+            lib_.tj3Set(handle, TJPARAM_QUALITY, quality)
+            lib_.tj3Set(handle, TJPARAM_SUBSAMP, subsampling)
+            lib_.tj3Set(handle, TJPARAM_LOSSLESS, 1 if lossless else 0)
+            t0 = metrics.start()
+            n = getattr(lib_, name)(
+                handle,
+                jpeg.ffi.cast(ctype, src.__array_interface__["data"][0]),
+                src.shape[1], src.strides[0] // src.itemsize, src.shape[0],
+                pixfmt, pbuf, psize)
+            if t0 is not None:
+                metrics.record(name, t0, src.nbytes, error=n)
+            if n:
+                raise JPEGRuntimeError("%s() failed with error %d and error "
+                                       "string %s" %
+                                       (name, n, self.get_last_error()), n)
+            data = numpy.frombuffer(jpeg.ffi.buffer(pbuf[0], psize[0]),
+                                    dtype=numpy.uint8)
+            if dst is None:
+                return data.copy()
+            if dst.nbytes < data.nbytes:
+                raise ValueError("dst is too small to hold %d bytes" %
+                                 data.nbytes)
+            out = dst.reshape(-1)[:data.nbytes]
+            out[:] = data
+            return out
+        finally:
+            if pbuf[0] != jpeg.ffi.NULL:
+                lib_.tj3Free(pbuf[0])
+            if lossless:
+                # Lossless state sticks to the handle in libjpeg-turbo 3.0
+                # and corrupts the following encodes, so do not pool it
+                self.compressor.release()
+                self.compressor = None
+
+    def transform(self, op=TJXOP_NONE, crop=None, grayscale=False,
+                  progressive=False, perfect=False, trim=False,
+                  copy_none=False):
+        """Losslessly transforms JPEG without decoding it.
+
+        Parameters:
+            op: transform operation (TJXOP_*).
+            crop: (x, y, width, height) region of the transformed image
+                  to crop to, x and y should be aligned to MCU boundaries,
+                  zero width or height means up to the image edge.
+            grayscale: discard color data.
+            progressive: produce progressive JPEG.
+            perfect: fail if the transform is not perfect
+                     because of partial MCU blocks on the image edges.
+            trim: discard partial MCU blocks which cannot be transformed.
+            copy_none: do not copy extra markers (EXIF, comments, etc.).
+
+        Returns:
+            numpy uint8 array with the transformed JPEG data.
+        """
+        return self.transform_many([dict(
+            op=op, crop=crop, grayscale=grayscale, progressive=progressive,
+            perfect=perfect, trim=trim, copy_none=copy_none)])[0]
+
+    def transform_many(self, transforms):
+        """Applies several lossless transforms in a single tjTransform() call
+        so the source is parsed only once.
+
+        Parameters:
+            transforms: sequence of dictionaries with transform() arguments.
+
+        Returns:
+            list of numpy uint8 arrays with the transformed JPEG data.
+        """
+        n = len(transforms)
+        progressive = [bool(kwargs.get("progressive"))
+                       for kwargs in transforms]
+        if any(progressive) and not all(progressive):
+            # Progressive option sticks to the handle in libjpeg-turbo 3.0
+            # and corrupts the following transforms, so do them separately
+            results = [None] * n
+            for flag in (False, True):
+                idxs = [i for i in range(n) if progressive[i] == flag]
+                for i, result in zip(idxs, self.transform_many(
+                        [transforms[i] for i in idxs])):
+                    results[i] = result
+            return results
+        xforms = jpeg.ffi.new("tjtransform[]", n)
+        for i, kwargs in enumerate(transforms):
+            unknown = set(kwargs) - set((
+                "op", "crop", "grayscale", "progressive", "perfect", "trim",
+                "copy_none"))
+            if unknown:
+                raise ValueError("Unknown transform arguments: %s" %
+                                 ", ".join(sorted(unknown)))
+            xforms[i].op = kwargs.get("op", TJXOP_NONE)
+            options = 0
+            crop = kwargs.get("crop")
+            if crop is not None:
+                options |= TJXOPT_CROP
+                (xforms[i].r.x, xforms[i].r.y,
+                 xforms[i].r.w, xforms[i].r.h) = crop
+            for key, option in (("grayscale", TJXOPT_GRAY),
+                                ("progressive", TJXOPT_PROGRESSIVE),
+                                ("perfect", TJXOPT_PERFECT),
+                                ("trim", TJXOPT_TRIM),
+                                ("copy_none", TJXOPT_COPYNONE)):
+                if kwargs.get(key):
+                    options |= option
+            xforms[i].options = options
+        if self.precision is None and self._has_tj3():
+            # Needed to decide whether the handle can be pooled afterwards
+            self.parse_header()
+        dst_bufs = jpeg.ffi.new("unsigned char*[]", n)
+        dst_sizes = jpeg.ffi.new("unsigned long[]", n)
+        self._get_transformer()
+        try:
+            t0 = metrics.start()
+            err = self.lib_.tjTransform(
+                self.transformer.handle_,
+                jpeg.ffi.cast("unsigned char*",
+                              self.source.__array_interface__["data"][0]),
+                self.source.nbytes, n, dst_bufs, dst_sizes, xforms, 0)
+            if t0 is not None:
+                metrics.record("tjTransform", t0, self.source.nbytes,
+                               error=err)
+            if err:
+                raise JPEGRuntimeError("tjTransform() failed with error "
+                                       "%d and error string %s" %
+                                       (err, self.get_last_error()), err)
+            return [numpy.frombuffer(
+                jpeg.ffi.buffer(dst_bufs[i], dst_sizes[i]),
+                dtype=numpy.uint8).copy() for i in range(n)]
+        finally:
+            for i in range(n):
+                if dst_bufs[i] != jpeg.ffi.NULL:
+                    self.lib_.tjFree(dst_bufs[i])
+            if (n and progressive[0]) or (self.precision or 8) > 8:
+                # Do not return the handle with progressive or 12-bit state
+                # to the pool, it corrupts the following transforms
+                self.transformer.release()
+                self.transformer = None
+
+    def release(self):
+        """Returns handles to the pools.
+        """
         if self.decompressor is not None:
-            JPEG.decompressors.append(self.decompressor)
+            JPEG.decompressors.release(self.decompressor)
+            self.decompressor = None
+        if self.compressor is not None:
+            JPEG.compressors.release(self.compressor)
+            self.compressor = None
+        if self.transformer is not None:
+            JPEG.transformers.release(self.transformer)
+            self.transformer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+#: Number of threads in the pool shared by the parallel helpers
+POOL_SIZE = multiprocessing.cpu_count()
+
+
+#: Thread pool shared by the parallel helpers
+_pool = None
+
+
+#: Lock for _pool
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    """Returns the shared thread pool of POOL_SIZE threads.
+
+    The pool is created once and never shut down (other callers may
+    be submitting to it), the callers limit their own concurrency
+    by the number of tasks they keep submitted.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(1, POOL_SIZE))
+        return _pool
+
+
+def _parallel_map(func, items, workers):
+    """Calls func for each item using at most the specified number
+    of threads from the shared pool (and at most POOL_SIZE).
+
+    Returns:
+        list of results in the order of items.
+    """
+    items = list(items)
+    workers = max(1, min(workers, len(items)))
+    if workers == 1:
+        return [func(item) for item in items]
+
+    def run(k):
+        return [func(item) for item in items[k::workers]]
+
+    pool = _get_pool()
+    chunks = [f.result() for f in
+              [pool.submit(run, k) for k in range(workers)]]
+    results = [None] * len(items)
+    for k, chunk in enumerate(chunks):
+        results[k::workers] = chunk
+    return results
+
+
+def _scratch(shape, dtype=numpy.uint8):
+    """Returns uninitialized array of the specified shape over the thread
+    local reusable buffer.
+    """
+    nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    buf = getattr(JPEG.buffers, "scratch", None)
+    if buf is None or buf.nbytes < nbytes:
+        buf = numpy.empty(nbytes, dtype=numpy.uint8)
+        JPEG.buffers.scratch = buf
+    return buf[:nbytes].view(dtype).reshape(shape)
+
+
+def _tensor_shape(shape, layout):
+    """Returns shape of the (height, width, channels) image in the layout.
+    """
+    if layout == "CHW":
+        return (shape[2], shape[0], shape[1])
+    if layout != "HWC":
+        raise ValueError("layout should be either \"CHW\" or \"HWC\"")
+    return tuple(shape)
+
+
+def _tensor_out(out, shape, layout, dtype):
+    """Checks or allocates the output of the (height, width, channels)
+    image in the layout.
+    """
+    shape = _tensor_shape(shape, layout)
+    if out is None:
+        out = numpy.empty(shape, dtype=dtype)
+    elif not hasattr(out, "__array_interface__"):
+        raise ValueError("out should be numpy array or None")
+    if (out.shape != shape or out.dtype.kind != "f" or
+            not out.flags.c_contiguous):
+        raise ValueError("out should be contiguous floating point array "
+                         "of shape %s" % (shape,))
+    return out
+
+
+#: Bytes of float32 rows processed at once by _normalize()
+NORMALIZE_BLOCK = 256 << 10
+
+
+def _normalize(src, out, layout, mean, std):
+    """Writes (src - mean) / std from (height, width, channels) image
+    to out in the layout in blocks of rows fitting into the cache,
+    so each block is read from memory once.
+    """
+    height, width, channels = src.shape
+    scale = numpy.ones(channels, dtype=numpy.float32)
+    if std is not None:
+        scale /= numpy.broadcast_to(numpy.asarray(std, numpy.float32),
+                                    (channels,))
+    bias = numpy.zeros(channels, dtype=numpy.float32)
+    if mean is not None:
+        bias -= numpy.broadcast_to(numpy.asarray(mean, numpy.float32),
+                                   (channels,)) * scale
+    rows = max(1, NORMALIZE_BLOCK // (width * channels * 4))
+    if layout == "HWC":
+        # Per channel values repeated along the row keep the loops
+        # over whole contiguous rows
+        scale = numpy.tile(scale, width)
+        bias = numpy.tile(bias, width)
+        src = src.reshape(height, width * channels)
+        rows_out = out.reshape(height, width * channels)
+    for y in range(0, height, rows):
+        if layout == "HWC":
+            pairs = ((src[y:y + rows], rows_out[y:y + rows], scale, bias),)
+        else:
+            pairs = ((src[y:y + rows, :, c], out[c, y:y + rows],
+                      scale[c], bias[c]) for c in range(channels))
+        for block, dst, scl, b in pairs:
+            dst[...] = block
+            dst *= scl
+            dst += b
+    return out
+
+
+def _fit_nearest(src, dst):
+    """Copies src to dst with nearest-neighbour resize.
+    """
+    rows = (numpy.arange(dst.shape[0]) * src.shape[0]) // dst.shape[0]
+    cols = (numpy.arange(dst.shape[1]) * src.shape[1]) // dst.shape[1]
+    dst[...] = src[rows[:, None], cols]
+
+
+def _decode_into(jp, dst, pixfmt, policy, flags=None):
+    """Decodes jp into the batch slot dst according to policy.
+    """
+    height, width = dst.shape[0], dst.shape[1]
+    if jp.height == height and jp.width == width:
+        jp.decode(dst, pixfmt, flags=flags)
+        return
+    if policy == "resize":
+        # Let libjpeg-turbo downscale in DCT domain as much as possible
+        f = jp.get_scaling_factor(min_size=(width, height))
+        _fit_nearest(jp.decode(pixfmt=pixfmt, scale=f, flags=flags), dst)
+        return
+    h, w = min(jp.height, height), min(jp.width, width)
+    if h == jp.height and w == jp.width:
+        jp.decode(dst[:h, :w], pixfmt, flags=flags)
+    else:
+        dst[:h, :w] = jp.decode(pixfmt=pixfmt, flags=flags)[:h, :w]
+    dst[h:] = 0
+    dst[:h, w:] = 0
+
+
+def _prepare_batch(sources, policy, workers, lib_):
+    """Checks policy and parses the headers of the batch sources
+    in parallel.
+
+    Returns:
+        (list of JPEG objects, workers, largest height, largest width).
+    """
+    if policy not in ("pad", "resize"):
+        raise ValueError("policy should be either \"pad\" or \"resize\"")
+    jps = [src if isinstance(src, JPEG) else JPEG(src, lib_)
+           for src in sources]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def parse_header(jp):
+        if jp.width is None:
+            jp.parse_header()
+
+    _parallel_map(parse_header, jps, workers)
+    return (jps, workers, max((jp.height for jp in jps), default=0),
+            max((jp.width for jp in jps), default=0))
+
+
+def decode_batch(sources, out=None, pixfmt=TJPF_RGB, workers=None,
+                 policy="pad", lib_=None, mode=None, flags=None):
+    """Decodes several images into one contiguous (N, H, W[, C]) array.
+
+    Headers are parsed first, then every image is decoded directly into
+    its slice of the output on a persistent thread pool
+    (cffi releases GIL for the duration of libjpeg-turbo calls).
+
+    Parameters:
+        sources: sequence of JPEG objects or sources accepted by JPEG().
+        out: preallocated numpy uint8 array of shape (N, H, W[, C])
+             or None to allocate one fitting the largest image.
+        pixfmt: pixel format of the output.
+        workers: number of images decoded at once, at most POOL_SIZE
+                 (defaults to cpu count).
+        policy: how to fit an image with a shape different from the slot:
+                "pad" - place it at the top-left corner (cropping
+                if necessary) and zero the remainder,
+                "resize" - nearest-neighbour resize to the slot shape.
+        lib_: cffi handle to loaded shared library.
+        mode: speed/accuracy trade-off from DECODE_MODES.
+        flags: TJFLAG_* flags (see decode_flags()).
+
+    Returns:
+        out.
+    """
+    flags = decode_flags(mode, flags)
+    jps, workers, height, width = _prepare_batch(sources, policy, workers,
+                                                 lib_)
+    bpp = jpeg.tjPixelSize[pixfmt]
+    if out is None:
+        sh = [len(jps), height, width]
+        if bpp > 1:
+            sh.append(bpp)
+        out = numpy.empty(sh, dtype=numpy.uint8)
+    elif not hasattr(out, "__array_interface__"):
+        raise ValueError("out should be numpy array or None")
+    if out.dtype != numpy.uint8:
+        raise ValueError("out should be of uint8 dtype")
+    if len(out.shape) != (4 if bpp > 1 else 3):
+        raise ValueError("out shape length should be 4 for %d bytes per "
+                         "pixel or 3 for a single byte" % bpp)
+    if bpp > 1 and out.shape[3] != bpp:
+        raise ValueError(
+            "out last dimension should match the requested pixel format")
+    if out.shape[0] < len(jps):
+        raise ValueError("out is too small to hold all the images")
+    if out.size and (out.strides[-1] != 1 or
+                     (bpp > 1 and out.strides[2] != bpp)):
+        raise ValueError("out rows should be contiguous")
+
+    def decode(i):
+        _decode_into(jps[i], out[i], pixfmt, policy, flags)
+
+    _parallel_map(decode, range(len(jps)), workers)
+    return out
+
+
+def decode_batch_tensor(sources, out=None, layout="CHW",
+                        dtype=numpy.float32, mean=None, std=None,
+                        pixfmt=TJPF_RGB, workers=None, policy="pad",
+                        lib_=None, mode=None, flags=None):
+    """Decodes several images into one normalized floating point
+    (N, C, H, W) or (N, H, W, C) tensor.
+
+    Every image is decoded to the thread local scratch buffer and
+    normalized directly into its slice of the output
+    (see JPEG.decode_tensor()).
+
+    Parameters:
+        sources: sequence of JPEG objects or sources accepted by JPEG().
+        out: preallocated numpy floating point array
+             or None to allocate one fitting the largest image.
+        layout: "CHW" or "HWC" layout of the images.
+        dtype: floating point dtype of the output if out is None.
+        mean: scalar or per channel value to subtract (in pixel units).
+        std: scalar or per channel value to divide by (in pixel units).
+        pixfmt: pixel format of the decoded images.
+        workers: number of images decoded at once, at most POOL_SIZE
+                 (defaults to cpu count).
+        policy: how to fit an image with a shape different from the slot
+                (see decode_batch()).
+        lib_: cffi handle to loaded shared library.
+        mode: speed/accuracy trade-off from DECODE_MODES.
+        flags: TJFLAG_* flags (see decode_flags()).
+
+    Returns:
+        out.
+    """
+    if layout not in ("CHW", "HWC"):
+        raise ValueError("layout should be either \"CHW\" or \"HWC\"")
+    flags = decode_flags(mode, flags)
+    jps, workers, height, width = _prepare_batch(sources, policy, workers,
+                                                 lib_)
+    bpp = jpeg.tjPixelSize[pixfmt]
+    if out is None:
+        out = numpy.empty(
+            (len(jps),) + _tensor_shape((height, width, bpp), layout),
+            dtype=dtype)
+    elif not hasattr(out, "__array_interface__"):
+        raise ValueError("out should be numpy array or None")
+    if len(out.shape) != 4 or out.shape[0] < len(jps):
+        raise ValueError("out should be 4-dimensional array "
+                         "holding all the images")
+    if layout == "CHW":
+        sh = (out.shape[2], out.shape[3], out.shape[1])
+    else:
+        sh = out.shape[1:]
+    if sh[2] != bpp:
+        raise ValueError(
+            "out channels should match the requested pixel format")
+
+    def decode(i):
+        src = _scratch(sh if bpp > 1 else sh[:2])
+        _decode_into(jps[i], src, pixfmt, policy, flags)
+        _normalize(src.reshape(sh), _tensor_out(out[i], sh, layout, dtype),
+                   layout, mean, std)
+
+    _parallel_map(decode, range(len(jps)), workers)
+    return out
+
+
+def _after_fork():
+    """Resets state inherited from the parent process in the child:
+    idle handles belong to the parent and threads of the pool are gone.
+    """
+    global _pool, _pool_lock
+    JPEG.decompressors.reset()
+    JPEG.compressors.reset()
+    JPEG.transformers.reset()
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,215 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+
+"""
+Streaming decode of images stored in tar or zip archives and directories.
+"""
+import collections
+from jpeg4py._cffi import TJPF_RGB
+from jpeg4py._py import JPEG, _get_pool
+import multiprocessing
+import os
+import queue
+import tarfile
+import threading
+import zipfile
+
+
+#: File name extensions of the members decoded by default
+EXTENSIONS = (".jpg", ".jpeg")
+
+
+#: Size of sequential reads from archives
+READ_SIZE = 1 << 20
+
+
+def _iter_tar(fileobj, extensions):
+    # Stream mode reads the archive strictly sequentially
+    with tarfile.open(fileobj=fileobj, mode="r|*",
+                      bufsize=READ_SIZE) as tar:
+        for member in tar:
+            if member.isfile() and member.name.lower().endswith(extensions):
+                yield member.name, tar.extractfile(member).read()
+
+
+def _iter_tar_file(fnme, extensions):
+    with open(fnme, "rb", buffering=READ_SIZE) as fin:
+        for item in _iter_tar(fin, extensions):
+            yield item
+
+
+def _iter_zip(fnme, extensions):
+    with zipfile.ZipFile(fnme) as zf:
+        infos = sorted(zf.infolist(), key=lambda info: info.header_offset)
+        for info in infos:
+            if (not info.filename.endswith("/") and
+                    info.filename.lower().endswith(extensions)):
+                yield info.filename, zf.read(info)
+
+
+def _iter_dir(dirnme, extensions):
+    for root, dirs, files in os.walk(dirnme):
+        dirs.sort()
+        for fnme in sorted(files):
+            if fnme.lower().endswith(extensions):
+                path = os.path.join(root, fnme)
+                with open(path, "rb") as fin:
+                    data = fin.read()
+                yield os.path.relpath(path, dirnme).replace(os.sep, "/"), data
+
+
+def iter_members(source, extensions=EXTENSIONS):
+    """Iterates over the images stored in source without decoding them.
+
+    Parameters:
+        source: directory, tar (optionally compressed) or zip file name,
+                or binary file object with tar stream.
+        extensions: tuple of lowercase file name extensions to select.
+
+    Returns:
+        iterator of (key, bytes) in storage order, key is the member name
+        or the path relative to the directory with "/" separators.
+    """
+    extensions = tuple(extensions)
+    if hasattr(source, "read"):
+        return _iter_tar(source, extensions)
+    if os.path.isdir(source):
+        return _iter_dir(source, extensions)
+    if zipfile.is_zipfile(source):
+        return _iter_zip(source, extensions)
+    return _iter_tar_file(source, extensions)
+
+
+def _read_ahead(items, size):
+    """Iterates over items on a separate thread at most size items ahead
+    of the consumer, exceptions are reraised in the consumer.
+    """
+    buffer = queue.Queue(size)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((end, e))
+        else:
+            put((end, None))
+        finally:
+            if hasattr(items, "close"):
+                items.close()
+
+    thread = threading.Thread(target=read, name="jpeg4py read-ahead")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if item is end:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def stream(source, pixfmt=TJPF_RGB, workers=None, read_ahead=None,
+           extensions=EXTENSIONS, scale=None, max_size=None, lib_=None,
+           mode=None, flags=None):
+    """Decodes the images stored in source.
+
+    The members are read sequentially by a separate thread while
+    the previously read ones are decoded in parallel on the shared pool
+    (see POOL_SIZE), at most workers at once.
+
+    Parameters:
+        source: directory, tar (optionally compressed) or zip file name,
+                or binary file object with tar stream.
+        pixfmt: pixel format of the output.
+        workers: number of images decoded at once (defaults to cpu count).
+        read_ahead: maximum number of read and not yet decoded members
+                    (defaults to 2 * workers).
+        extensions: tuple of lowercase file name extensions to select.
+        scale: desired scale (see JPEG.get_scaling_factor()).
+        max_size: maximum output size (see JPEG.get_scaling_factor()).
+        lib_: cffi handle to loaded shared library.
+        mode: speed/accuracy trade-off from DECODE_MODES.
+        flags: TJFLAG_* flags (see decode_flags()).
+
+    Returns:
+        iterator of (key, numpy array) in storage order (see iter_members()).
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if read_ahead is None:
+        read_ahead = 2 * workers
+    if workers < 1 or read_ahead < 1:
+        raise ValueError("workers and read_ahead should be positive")
+
+    def decode(data):
+        with JPEG(data, lib_) as jp:
+            return jp.decode(pixfmt=pixfmt, scale=scale, max_size=max_size,
+                             mode=mode, flags=flags)
+
+    members = _read_ahead(iter_members(source, extensions), read_ahead)
+    pending = collections.deque()
+    try:
+        for key, data in members:
+            # The pool is looked up on every submit, so the generator
+            # does not keep it across yields (it is recreated after fork)
+            pending.append((key, _get_pool().submit(decode, data)))
+            if len(pending) >= workers:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+    finally:
+        members.close()
+        for _key, future in pending:
+            future.cancel()
@@ -0,0 +1,278 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+
+"""
+Transcoding helpers: thumbnails and encoding to the size budget.
+"""
+import jpeg4py._cffi as jpeg
+from jpeg4py._cffi import TJPF_RGB, TJFLAG_NOREALLOC
+from jpeg4py._metrics import metrics
+from jpeg4py._py import JPEG, JPEGRuntimeError, decode_flags
+import math
+import numpy
+
+
+def _sum_spans(src, n, axis):
+    """Sums src along the axis over n consecutive spans of nearly
+    equal length.
+    """
+    size = src.shape[axis]
+    starts = (numpy.arange(n + 1) * size) // n
+    counts = numpy.diff(starts)
+    acc = numpy.take(src, starts[:-1], axis=axis).astype(numpy.uint32)
+    for j in range(1, counts.max()):
+        # Spans differ in length by one at most, so only the last pass
+        # has to drop the rows beyond the shorter spans
+        part = numpy.take(src, numpy.minimum(starts[:-1] + j, size - 1),
+                          axis=axis)
+        if j >= counts.min():
+            shape = [1] * len(src.shape)
+            shape[axis] = n
+            part = part * (j < counts).reshape(shape).astype(numpy.uint8)
+        acc += part
+    return acc, counts
+
+
+def _fit_area(src, height, width):
+    """Returns src downscaled to (height, width) by averaging the source
+    pixels falling into each output pixel.
+    """
+    if src.shape[0] == height and src.shape[1] == width:
+        return src
+    acc, rows = _sum_spans(src, height, 0)
+    acc, cols = _sum_spans(acc, width, 1)
+    count = rows[:, None] * cols[None, :]
+    if len(src.shape) == 3:
+        count = count[:, :, None]
+    return ((acc + count // 2) // count).astype(numpy.uint8)
+
+
+def _target_size(width, height, size):
+    """Returns (width, height) of the image fitted into size
+    (int or (width, height) tuple) keeping the aspect ratio
+    without upscaling.
+    """
+    if not isinstance(size, tuple):
+        size = (size, size)
+    if size[0] < 1 or size[1] < 1:
+        raise ValueError("sizes should be positive")
+    ratio = min(float(size[0]) / width, float(size[1]) / height, 1.0)
+    return (min(width, max(1, int(round(width * ratio)))),
+            min(height, max(1, int(round(height * ratio)))))
+
+
+def thumbnails(source, sizes, quality=85, subsampling=None, pixfmt=TJPF_RGB,
+               lib_=None, mode=None, flags=None):
+    """Produces JPEG thumbnails of several sizes from one JPEG.
+
+    The header is parsed once. Sizes are processed from the largest one:
+    a size is resized from the previous thumbnail when that covers it,
+    otherwise the image is decoded with the smallest DCT scaling factor
+    covering the size (each factor is decoded at most once).
+    The final resize averages the remaining reduction: less than 2x
+    after DCT scaling, more for the sizes below the smallest factor
+    or resized from the previous thumbnail.
+    Decompressor and compressor handles and the encoding buffer
+    are taken from the thread local pools.
+
+    Parameters:
+        source: JPEG object or source accepted by JPEG().
+        sizes: sequence of bounding boxes (int or (width, height) tuple),
+               the aspect ratio is kept and images are not upscaled.
+        quality: JPEG quality (1 to 100).
+        subsampling: level of chrominance subsampling (see JPEG.encode()).
+        pixfmt: pixel format to decode to and encode from.
+        lib_: cffi handle to loaded shared library.
+        mode: speed/accuracy trade-off from DECODE_MODES.
+        flags: TJFLAG_* flags (see decode_flags()).
+
+    Returns:
+        list of numpy uint8 arrays with JPEG data in the order of sizes.
+    """
+    flags = decode_flags(mode, flags)
+    if isinstance(source, JPEG):
+        return _thumbnails(source, sizes, quality, subsampling, pixfmt,
+                           flags)
+    with JPEG(source, lib_) as jp:
+        return _thumbnails(jp, sizes, quality, subsampling, pixfmt, flags)
+
+
+def _thumbnails(jp, sizes, quality, subsampling, pixfmt, flags):
+    """Implements thumbnails() for JPEG object jp.
+    """
+    if jp.width is None:
+        jp.parse_header()
+    targets = [_target_size(jp.width, jp.height, size) for size in sizes]
+    results = [None] * len(targets)
+    decoded = {}
+    prev = None
+    for i in sorted(range(len(targets)),
+                    key=lambda i: targets[i][0] * targets[i][1],
+                    reverse=True):
+        width, height = targets[i]
+        if (prev is None or prev.shape[0] < height or
+                prev.shape[1] < width):
+            f = jp.get_scaling_factor(min_size=(width, height))
+            prev = decoded.get(f)
+            if prev is None:
+                prev = jp.decode(pixfmt=pixfmt, scale=f, flags=flags)
+                decoded[f] = prev
+        prev = _fit_area(prev, height, width)
+        with JPEG(prev, jp.lib_) as thumb:
+            results[i] = thumb.encode(quality=quality,
+                                      subsampling=subsampling,
+                                      pixfmt=pixfmt)
+    return results
+
+
+#: Quality probed first by encode_to_size()
+SIZE_SEARCH_START = 75
+
+
+#: Assumed growth of log(JPEG size) per quality unit until
+#: two probes are known
+SIZE_SEARCH_SLOPE = 0.03
+
+
+def _compress_yuv(jp, yuv, quality, subsampling, buf):
+    """Compresses YUV image produced by tjEncodeYUV2() from jp.source
+    to buf and returns the size of JPEG data.
+    """
+    height, width = jp.source.shape[0], jp.source.shape[1]
+    pbuf = jpeg.ffi.new("unsigned char**", jpeg.ffi.cast(
+        "unsigned char*", buf.__array_interface__["data"][0]))
+    psize = jpeg.ffi.new("unsigned long*", buf.nbytes)
+    t0 = metrics.start()
+    n = jp.lib_.tjCompressFromYUV(
+        jp.compressor.handle_,
+        jpeg.ffi.cast("unsigned char*", yuv.__array_interface__["data"][0]),
+        width, 4, height, subsampling, pbuf, psize, quality,
+        TJFLAG_NOREALLOC)
+    if t0 is not None:
+        metrics.record("tjCompressFromYUV", t0, yuv.nbytes, error=n)
+    if n:
+        raise JPEGRuntimeError("tjCompressFromYUV() failed with error "
+                               "%d and error string %s" %
+                               (n, jp.get_last_error()), n)
+    return int(psize[0])
+
+
+def encode_to_size(source, max_bytes, subsampling=None, pixfmt=None,
+                   min_quality=1, max_quality=95, lib_=None):
+    """Encodes image to JPEG with the highest quality fitting
+    into max_bytes.
+
+    Color conversion and chrominance downsampling are done once
+    with tjEncodeYUV2(), then the quality is searched with
+    tjCompressFromYUV() into one buffer: each probe interpolates
+    log(size) between the nearest probes fitting and not fitting,
+    which usually reaches the answer in 3-5 passes.
+
+    Parameters:
+        source: numpy uint8 array of shape (height, width[, channels]).
+        max_bytes: size budget for JPEG data.
+        subsampling: level of chrominance subsampling (see JPEG.encode()).
+        pixfmt: pixel format of source (see JPEG.encode()).
+        min_quality: lowest acceptable quality.
+        max_quality: highest quality to try.
+        lib_: cffi handle to loaded shared library.
+
+    Returns:
+        (numpy uint8 array with JPEG data, quality) tuple.
+    """
+    if not hasattr(source, "__array_interface__") or (
+            len(source.shape) not in (2, 3) or source.dtype != numpy.uint8):
+        raise ValueError("source should be uint8 array of shape "
+                         "(height, width) or (height, width, channels)")
+    if not 1 <= min_quality <= max_quality <= 100:
+        raise ValueError("qualities should satisfy "
+                         "1 <= min_quality <= max_quality <= 100")
+    with JPEG(source, lib_) as jp:
+        pixfmt, subsampling = jp._source_format(pixfmt, subsampling)
+        height, width = source.shape[0], source.shape[1]
+        lib_ = jp.lib_
+        yuv = numpy.empty(int(lib_.tjBufSizeYUV(width, height, subsampling)),
+                          dtype=numpy.uint8)
+        buf = numpy.empty(int(lib_.tjBufSize(width, height, subsampling)),
+                          dtype=numpy.uint8)
+        jp._get_compressor()
+        t0 = metrics.start()
+        n = lib_.tjEncodeYUV2(
+            jp.compressor.handle_,
+            jpeg.ffi.cast("unsigned char*",
+                          source.__array_interface__["data"][0]),
+            width, source.strides[0], height, pixfmt,
+            jpeg.ffi.cast("unsigned char*",
+                          yuv.__array_interface__["data"][0]),
+            subsampling, 0)
+        if t0 is not None:
+            metrics.record("tjEncodeYUV2", t0, source.nbytes, error=n)
+        if n:
+            raise JPEGRuntimeError("tjEncodeYUV2() failed with error "
+                                   "%d and error string %s" %
+                                   (n, jp.get_last_error()), n)
+        target = math.log(max_bytes) if max_bytes > 0 else -1.0
+        fit = None  # (quality, log(size), JPEG data) of the best fitting
+        over = None  # (quality, log(size)) of the lowest not fitting
+        quality = min(max(SIZE_SEARCH_START, min_quality), max_quality)
+        while True:
+            size = _compress_yuv(jp, yuv, quality, subsampling, buf)
+            if size <= max_bytes:
+                fit = (quality, math.log(size), buf[:size].copy())
+            else:
+                over = (quality, math.log(size))
+            if fit is not None and over is not None:
+                if over[0] - fit[0] <= 1:
+                    break
+                quality = fit[0] + (target - fit[1]) / (
+                    over[1] - fit[1]) * (over[0] - fit[0])
+                quality = min(max(int(quality), fit[0] + 1), over[0] - 1)
+            elif fit is not None:
+                if fit[0] >= max_quality:
+                    break
+                quality = min(max(
+                    int(fit[0] + (target - fit[1]) / SIZE_SEARCH_SLOPE),
+                    fit[0] + 1), max_quality)
+            else:
+                if over[0] <= min_quality:
+                    raise ValueError("image does not fit into %d bytes "
+                                     "at quality %d" %
+                                     (max_bytes, min_quality))
+                quality = max(min(
+                    int(math.floor(over[0] + (target - over[1]) /
+                                   SIZE_SEARCH_SLOPE)),
+                    over[0] - 1), min_quality)
+        return fit[2], fit[0]
@@ -0,0 +1,182 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+"""
+asyncio interface: decoding on a dedicated thread pool
+without blocking the event loop (requires Python 3.5+).
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from jpeg4py._cffi import TJPF_RGB
+from jpeg4py._py import JPEG
+import multiprocessing
+import os
+import threading
+import weakref
+
+
+class AsyncDecoder(object):
+    """Runs JPEG operations on a dedicated thread pool.
+
+    Handles are returned to the pool right after each operation
+    by the worker thread itself, so they stay in the thread local slots
+    of the workers and are never leaked by a cancelled coroutine.
+
+    Attributes:
+        workers: number of worker threads.
+        max_pending: maximum number of operations submitted at once,
+                     other callers wait without occupying the executor.
+        executor: ThreadPoolExecutor instance.
+    """
+    def __init__(self, workers=None, max_pending=None):
+        """Constructor.
+
+        Parameters:
+            workers: number of worker threads (defaults to cpu count).
+            max_pending: maximum number of operations submitted at once
+                         (defaults to workers * 2).
+        """
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_pending = max_pending or self.workers * 2
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self, loop):
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_pending)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, func, *args):
+        """Calls func(*args) on the executor respecting max_pending.
+        """
+        loop = asyncio.get_event_loop()
+        async with self._get_semaphore(loop):
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def decode(self, source, dst=None, pixfmt=TJPF_RGB, **kwargs):
+        """Decodes JPEG (see JPEG.decode()).
+
+        Parameters:
+            source: JPEG object or source accepted by JPEG().
+        """
+        return await self.run(_decode, source, dst, pixfmt, kwargs)
+
+    async def parse_header(self, source, **kwargs):
+        """Parses JPEG header (see JPEG.parse_header()).
+
+        Parameters:
+            source: JPEG object or source accepted by JPEG().
+
+        Returns:
+            JPEG object with the parsed header.
+        """
+        return await self.run(_parse_header, source, kwargs)
+
+    def shutdown(self, wait=True):
+        """Shuts the executor down.
+        """
+        self.executor.shutdown(wait=wait)
+
+
+def _decode(source, dst, pixfmt, kwargs):
+    jp = source if isinstance(source, JPEG) else JPEG(source)
+    with jp:
+        return jp.decode(dst, pixfmt, **kwargs)
+
+
+def _parse_header(source, kwargs):
+    jp = source if isinstance(source, JPEG) else JPEG(source)
+    with jp:
+        jp.parse_header(**kwargs)
+    return jp
+
+
+#: Decoder used by the module level functions
+_decoder = None
+
+
+#: Lock for _decoder
+_decoder_lock = threading.Lock()
+
+
+def configure(workers=None, max_pending=None):
+    """Replaces the decoder used by the module level functions.
+
+    Parameters:
+        workers: number of worker threads (defaults to cpu count).
+        max_pending: maximum number of operations submitted at once.
+    """
+    global _decoder
+    with _decoder_lock:
+        old = _decoder
+        _decoder = AsyncDecoder(workers, max_pending)
+    if old is not None:
+        old.shutdown(wait=False)
+
+
+def get_decoder():
+    """Returns the decoder used by the module level functions.
+    """
+    global _decoder
+    if _decoder is None:
+        with _decoder_lock:
+            if _decoder is None:
+                _decoder = AsyncDecoder()
+    return _decoder
+
+
+async def decode_async(source, dst=None, pixfmt=TJPF_RGB, **kwargs):
+    """Decodes JPEG on the default AsyncDecoder (see JPEG.decode()).
+    """
+    return await get_decoder().decode(source, dst, pixfmt, **kwargs)
+
+
+async def parse_header_async(source, **kwargs):
+    """Parses JPEG header on the default AsyncDecoder
+    (see JPEG.parse_header()).
+    """
+    return await get_decoder().parse_header(source, **kwargs)
+
+
+def _after_fork():
+    global _decoder, _decoder_lock
+    _decoder = None
+    _decoder_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,267 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+"""
+Benchmark suite, run with:
+python -m jpeg4py.bench [--quick] [--output FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import jpeg4py._cffi as jpeg
+from jpeg4py._cffi import TJSAMP_444, TJSAMP_420, TJPF_RGB
+from jpeg4py._headers import read_header
+from jpeg4py._py import JPEG
+import numpy
+import platform
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+#: Configurations of the synthetic images: (size, subsampling, quality)
+CONFIGS = [(size, samp, quality)
+           for size in (64, 256, 1024, 4096)
+           for samp in (TJSAMP_444, TJSAMP_420)
+           for quality in (75, 95)]
+
+
+#: Subsampling names used in the result keys
+_samp_names = {TJSAMP_444: "444", TJSAMP_420: "420"}
+
+
+def synthetic_jpeg(size, subsampling, quality, seed=0):
+    """Returns reproducible synthetic JPEG as numpy uint8 array.
+    """
+    rand = numpy.random.RandomState(seed)
+    y, x = numpy.mgrid[0:size, 0:size].astype(numpy.float32) / size
+    img = numpy.empty((size, size, 3), dtype=numpy.float32)
+    img[:, :, 0] = x * 255
+    img[:, :, 1] = y * 255
+    img[:, :, 2] = (numpy.sin(x * 20) * numpy.cos(y * 13) + 1) * 127
+    img += rand.normal(0, 12, img.shape)
+    img = numpy.clip(img, 0, 255).astype(numpy.uint8)
+    return JPEG(img).encode(quality=quality, subsampling=subsampling)
+
+
+def _percentiles(samples):
+    a = numpy.array(samples) * 1e6
+    return {"p50_us": float(numpy.percentile(a, 50)),
+            "p90_us": float(numpy.percentile(a, 90)),
+            "p99_us": float(numpy.percentile(a, 99)),
+            "mean_us": float(a.mean())}
+
+
+def _timed(func, n):
+    samples = []
+    for _i in range(n):
+        t0 = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - t0)
+    return samples
+
+
+def bench_latency(raw, n):
+    """Single image decode latency percentiles.
+    """
+    _timed(lambda: JPEG(raw).decode(), max(1, n // 10))
+    return _percentiles(_timed(lambda: JPEG(raw).decode(), n))
+
+
+def bench_header(raw, n):
+    """Header parsing cost with TurboJPEG and with read_header().
+    """
+    return {"parse_header": _percentiles(
+                _timed(lambda: JPEG(raw).parse_header(), n)),
+            "read_header": _percentiles(
+                _timed(lambda: read_header(raw), n))}
+
+
+def bench_throughput(raw, threads, seconds):
+    """Images per second decoded by the specified number of threads.
+    """
+    counts = [0] * threads
+    stop = threading.Event()
+
+    def loop(k):
+        while not stop.is_set():
+            JPEG(raw).decode()
+            counts[k] += 1
+
+    th = [threading.Thread(target=loop, args=(k,)) for k in range(threads)]
+    t0 = time.perf_counter()
+    for t in th:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in th:
+        t.join()
+    return sum(counts) / (time.perf_counter() - t0)
+
+
+def bench_overhead(n):
+    """Python overhead per decode() call: the difference with
+    the bare tjDecompress2 call on a reused handle and buffer.
+    """
+    raw = synthetic_jpeg(8, TJSAMP_444, 75)
+    jp = JPEG(raw)
+    jp.parse_header()
+    dst = numpy.empty((8, 8, 3), dtype=numpy.uint8)
+    jp._get_decompressor()
+    handle = jp.decompressor.handle_
+    src = jpeg.ffi.cast("unsigned char*", raw.__array_interface__["data"][0])
+    ptr = jpeg.ffi.cast("unsigned char*", dst.__array_interface__["data"][0])
+    lib = jp.lib_
+
+    def bare():
+        lib.tjDecompress2(handle, src, raw.nbytes, ptr, 8, 24, 8,
+                          TJPF_RGB, 0)
+
+    bare_us = numpy.median(_timed(bare, n)) * 1e6
+    full_us = numpy.median(_timed(lambda: JPEG(raw).decode(), n)) * 1e6
+    return {"bare_call_us": float(bare_us), "decode_us": float(full_us),
+            "overhead_us": float(full_us - bare_us)}
+
+
+def peak_rss_kb():
+    """Returns peak resident set size of the process in KB or None.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run(configs=CONFIGS, n=200, threads=(1, 2, 4, 8), seconds=1.0):
+    """Runs the suite.
+
+    Returns:
+        dictionary with the results.
+    """
+    jpeg.initialize()
+    results = {"meta": {"python": platform.python_version(),
+                        "implementation": platform.python_implementation(),
+                        "machine": platform.machine()},
+               "images": {}}
+    for size, samp, quality in configs:
+        raw = synthetic_jpeg(size, samp, quality)
+        count = max(5, n * 64 // size)
+        key = "%d_%s_q%d" % (size, _samp_names.get(samp, samp), quality)
+        results["images"][key] = {
+            "bytes": int(raw.nbytes),
+            "latency": bench_latency(raw, count),
+            "header": bench_header(raw, count),
+            "throughput": {str(t): bench_throughput(raw, t, seconds)
+                           for t in threads}}
+    results["overhead"] = bench_overhead(n * 10)
+    results["peak_rss_kb"] = peak_rss_kb()
+    return results
+
+
+def _flatten(d, prefix=""):
+    flat = {}
+    for key, value in d.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compares results with the baseline.
+
+    Median latencies (p50_us) and peak_rss_kb are expected not to grow
+    and throughput not to drop by more than threshold (relative),
+    other percentiles are too noisy to be compared.
+
+    Returns:
+        list of (metric, baseline value, current value) regressions.
+    """
+    current = _flatten(results)
+    regressions = []
+    for name, old in sorted(_flatten(baseline).items()):
+        new = current.get(name)
+        if new is None or not old or name.startswith("meta."):
+            continue
+        if ".throughput." in name:
+            if new < old * (1 - threshold):
+                regressions.append((name, old, new))
+        elif name.endswith("p50_us") or name == "peak_rss_kb":
+            if new > old * (1 + threshold):
+                regressions.append((name, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m jpeg4py.bench",
+                                     description="jpeg4py benchmark")
+    parser.add_argument("--quick", action="store_true",
+                        help="small images and short runs only")
+    parser.add_argument("--output", help="file to write JSON results to "
+                        "(stdout by default)")
+    parser.add_argument("--baseline",
+                        help="JSON results to compare with, exit code is 1 "
+                        "if regressions are found")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative regression threshold (0.1)")
+    args = parser.parse_args(argv)
+    if args.quick:
+        results = run(configs=[c for c in CONFIGS if c[0] <= 256], n=50,
+                      threads=(1, 2), seconds=0.2)
+    else:
+        results = run()
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fout:
+            fout.write(data + "\n")
+    else:
+        print(data)
+    if args.baseline:
+        with open(args.baseline) as fin:
+            regressions = compare(results, json.load(fin), args.threshold)
+        for name, old, new in regressions:
+            sys.stderr.write("REGRESSION %s: %.6g -> %.6g\n" %
+                             (name, old, new))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
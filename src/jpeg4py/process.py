@@ -0,0 +1,172 @@
+"""
+Copyright (c) 2014, Samsung Electronics Co.,Ltd.
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+list of conditions and the following disclaimer.
+2. Redistributions in binary form must reproduce the above copyright notice,
+this list of conditions and the following disclaimer in the documentation
+and/or other materials provided with the distribution.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+The views and conclusions contained in the software and documentation are those
+of the authors and should not be interpreted as representing official policies,
+either expressed or implied, of Samsung Electronics Co.,Ltd..
+"""
+
+"""
+jpeg4py - libjpeg-turbo cffi bindings and helper classes.
+URL: https://github.com/ajkxyz/jpeg4py
+Original author: Alexey Kazantsev <a.kazantsev@samsung.com>
+"""
+
+"""
+Process pool decoding into shared memory (requires Python 3.8+).
+"""
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+from jpeg4py._cffi import TJPF_RGB
+import jpeg4py._cffi as jpeg
+from jpeg4py._py import JPEG, _decode_into, decode_flags
+import numpy
+
+
+#: State of the worker process
+_worker = {}
+
+
+def _init_worker(name, shape, pixfmt, policy, flags):
+    shm = shared_memory.SharedMemory(name=name)
+    _worker["shm"] = shm
+    _worker["buffers"] = numpy.ndarray(shape, dtype=numpy.uint8,
+                                       buffer=shm.buf)
+    _worker["pixfmt"] = pixfmt
+    _worker["policy"] = policy
+    _worker["flags"] = flags
+
+
+def _decode_slot(slot, source):
+    with JPEG(source) as jp:
+        jp.parse_header()
+        _decode_into(jp, _worker["buffers"][slot], _worker["pixfmt"],
+                     _worker["policy"], _worker["flags"])
+        return jp.height, jp.width
+
+
+class ProcessDecoder(object):
+    """Decodes JPEGs in worker processes directly into a ring of
+    reusable slots in one shared memory block, the parent gets
+    numpy views over the slots without copying or pickling pixels.
+
+    Attributes:
+        slots: number of slots in the ring.
+        buffers: numpy array of shape (slots, height, width[, bpp])
+                 over the shared memory.
+    """
+    def __init__(self, shape, pixfmt=TJPF_RGB, slots=None, workers=None,
+                 policy="pad", context=None, mode=None, flags=None):
+        """Constructor.
+
+        Parameters:
+            shape: (height, width) of a slot.
+            pixfmt: pixel format of the output.
+            slots: number of slots (defaults to workers * 2 + 1).
+            workers: number of worker processes (defaults to cpu count).
+            policy: how to fit images into the slots
+                    (see decode_batch()).
+            context: multiprocessing context or None for the default one.
+            mode: speed/accuracy trade-off from DECODE_MODES.
+            flags: TJFLAG_* flags (see decode_flags()).
+        """
+        if policy not in ("pad", "resize"):
+            raise ValueError(
+                "policy should be either \"pad\" or \"resize\"")
+        workers = workers or multiprocessing.cpu_count()
+        self.slots = slots or workers * 2 + 1
+        if self.slots < 2:
+            raise ValueError("at least 2 slots are required")
+        bpp = jpeg.tjPixelSize[pixfmt]
+        sh = (self.slots,) + tuple(shape) + ((bpp,) if bpp > 1 else ())
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=int(numpy.prod(sh)))
+        self.buffers = numpy.ndarray(sh, dtype=numpy.uint8,
+                                     buffer=self._shm.buf)
+        ctx = context or multiprocessing
+        self._pool = ctx.Pool(workers, _init_worker,
+                              (self._shm.name, sh, pixfmt, policy,
+                               decode_flags(mode, flags)))
+
+    def imap(self, sources):
+        """Decodes sources keeping up to slots - 1 of them in flight.
+
+        Parameters:
+            sources: iterable of file names or bytes.
+
+        Returns:
+            generator of (array, (height, width)) in the order of sources,
+            array is a view over the slot which stays valid only
+            until the next item is requested.
+        """
+        free = list(range(self.slots))
+        pending = collections.deque()
+        sources = iter(sources)
+        current = None
+        exhausted = False
+        while True:
+            while free and not exhausted:
+                try:
+                    source = next(sources)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slot = free.pop()
+                pending.append((slot, self._pool.apply_async(
+                    _decode_slot, (slot, source))))
+            if not pending:
+                return
+            slot, result = pending.popleft()
+            try:
+                size = result.get()
+            except BaseException:
+                for _slot, res in pending:
+                    res.wait()
+                raise
+            if current is not None:
+                free.append(current)
+            current = slot
+            yield self.buffers[slot], size
+
+    def close(self):
+        """Stops the workers and frees the shared memory.
+        """
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        self.buffers = None
+        self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:  # views are still referenced by the caller
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -42,6 +42,12 @@ import jpeg4py as jpeg
 import numpy
 import os
 import gc
+import json
+import asyncio
+import shutil
+import tempfile
+import threading
+import time
 
 
 class Test(unittest.TestCase):
@@ -127,6 +133,730 @@ class Test(unittest.TestCase):
         #pp.imshow(a)
         #pp.show()
 
+    def test_decode_batch(self):
+        dirnme = os.path.dirname(__file__)
+        big = os.path.join(dirnme, "1024.jpg")
+        a = jpeg.decode_batch([self.raw, big, self.raw], workers=2)
+        sm = jpeg.JPEG(self.raw).decode()
+        ref = jpeg.JPEG(big).decode()
+        self.assertEqual(a.shape, (3,) + ref.shape)
+        self.assertTrue((a[1] == ref).all())
+        self.assertTrue((a[2, :sm.shape[0], :sm.shape[1]] == sm).all())
+        self.assertEqual(a[0, sm.shape[0]:].max(), 0)
+        self.assertEqual(a[0, :, sm.shape[1]:].max(), 0)
+        out = numpy.empty((2, 32, 48), dtype=numpy.uint8)
+        b = jpeg.decode_batch([self.raw, big], out=out,
+                              pixfmt=jpeg.TJPF_GRAY, policy="resize")
+        self.assertIs(b, out)
+        self.assertRaises(ValueError, jpeg.decode_batch, [self.raw],
+                          out=out)
+        self.assertEqual(jpeg.decode_batch([]).shape, (0, 0, 0, 3))
+        self.assertEqual(jpeg.decode_batch(
+            [], pixfmt=jpeg.TJPF_GRAY).shape, (0, 0, 0))
+        self.assertEqual(jpeg.decode_batch_tensor([]).shape, (0, 3, 0, 0))
+        self.assertRaises(ValueError, jpeg.decode_batch, [], policy="crop")
+        jpeg.decode_batch([self.raw] * 4, workers=3)
+        pool = jpeg._py._pool
+        jpeg.decode_batch([self.raw] * 4, workers=2)
+        errors = []
+
+        def run(workers):
+            try:
+                for _i in range(5):
+                    jpeg.decode_batch([self.raw] * 8, workers=workers)
+                    workers += 1
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(w,))
+                   for w in (2, 3, 4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertIs(jpeg._py._pool, pool)
+
+    def test_decode_scaled(self):
+        dirnme = os.path.dirname(__file__)
+        jp = jpeg.JPEG(os.path.join(dirnme, "1024.jpg"))
+        self.assertIn((1, 8), jp.get_scaling_factors())
+        jp.parse_header(scale=0.5)
+        self.assertEqual(jp.width, 1024)
+        self.assertEqual(jp.scaling_factor, (1, 2))
+        self.assertEqual(jp.scaled_width, 512)
+        self.assertEqual(jp.scaled_height, 512)
+        a = jp.decode(scale=(1, 8))
+        self.assertEqual(a.shape, (128, 128, 3))
+        a = jp.decode(max_size=300, pixfmt=jpeg.TJPF_GRAY)
+        self.assertEqual(a.shape, (256, 256))
+        dst = numpy.zeros((300, 300, 3), dtype=numpy.uint8)
+        a = jp.decode(dst, max_size=(300, 300))
+        self.assertEqual(a.shape, (256, 256, 3))
+        self.assertEqual(dst[256:].max(), 0)
+        self.assertRaises(ValueError, jp.decode, dst, scale=0.5)
+        small = jpeg.JPEG(os.path.join(dirnme, "64.jpg"))
+        self.assertEqual(small.decode(max_size=300).shape, (64, 64, 3))
+
+    def test_encode(self):
+        a = jpeg.JPEG(self.raw).decode()
+        raw = jpeg.JPEG(a).encode(quality=90)
+        self.assertEqual(raw.dtype, numpy.uint8)
+        jp = jpeg.JPEG(raw)
+        jp.parse_header()
+        self.assertEqual((jp.height, jp.width), a.shape[:2])
+        self.assertEqual(jp.subsampling, jpeg.TJSAMP_420)
+        b = jp.decode()
+        self.assertLess(numpy.abs(a.astype(numpy.int32) - b).mean(), 8)
+        dst = numpy.empty(1 << 16, dtype=numpy.uint8)
+        raw2 = jpeg.JPEG(a).encode(dst, quality=90)
+        self.assertTrue((raw2 == raw).all())
+        self.assertEqual(raw2.__array_interface__["data"][0],
+                         dst.__array_interface__["data"][0])
+        gray = jpeg.JPEG(a[:, :, 0].copy()).encode()
+        jp = jpeg.JPEG(gray)
+        jp.parse_header()
+        self.assertEqual(jp.subsampling, jpeg.TJSAMP_GRAY)
+        self.assertRaises(ValueError, jpeg.JPEG(a).encode,
+                          numpy.empty(16, dtype=numpy.uint8))
+        self.assertRaises(ValueError, jpeg.JPEG(a).encode,
+                          numpy.empty(1 << 17, dtype=numpy.uint8)[::2])
+
+    def test_transform(self):
+        a = jpeg.JPEG(self.raw).decode()
+        jp = jpeg.JPEG(self.raw)
+        rot = jpeg.JPEG(jp.transform(jpeg.TJXOP_ROT90)).decode()
+        # IDCT of transposed blocks may differ in rounding
+        self.assertLessEqual(
+            numpy.abs(rot.astype(numpy.int32) - numpy.rot90(a, -1)).max(), 1)
+        flipped, cropped = jp.transform_many([
+            dict(op=jpeg.TJXOP_HFLIP),
+            dict(crop=(16, 8, 32, 24), grayscale=True)])
+        self.assertTrue((jpeg.JPEG(flipped).decode() == a[:, ::-1]).all())
+        c = jpeg.JPEG(cropped)
+        c.parse_header()
+        self.assertEqual((c.width, c.height), (32, 24))
+        self.assertEqual(c.subsampling, jpeg.TJSAMP_GRAY)
+        self.assertRaises(ValueError, jp.transform_many, [dict(rotate=90)])
+        prog, rot = jp.transform_many([dict(progressive=True),
+                                       dict(op=jpeg.TJXOP_ROT90)])
+        self.assertTrue((jpeg.JPEG(prog).decode() == a).all())
+        rot2 = jpeg.JPEG(jp.transform(jpeg.TJXOP_ROT90)).decode()
+        self.assertTrue((jpeg.JPEG(rot).decode() == rot2).all())
+        self.assertRaises(jpeg.JPEGRuntimeError, jp.transform,
+                          crop=(3, 3, 16, 16))
+
+    def test_decode_yuv(self):
+        a = jpeg.JPEG(self.raw).decode()[:61, :59]
+        raw = jpeg.JPEG(a).encode(subsampling=jpeg.TJSAMP_420)
+        jp = jpeg.JPEG(raw)
+        y, u, v = jp.decode_yuv()
+        self.assertEqual(y.shape, (62, 60))
+        self.assertEqual(u.shape, (31, 30))
+        self.assertEqual(v.shape, (31, 30))
+        self.assertTrue(
+            (y[:61, :59] == jp.decode(pixfmt=jpeg.TJPF_GRAY)).all())
+        self.assertEqual(jpeg.yuv_planes(59, 61, jpeg.TJSAMP_420),
+                         [(62, 60, 60), (31, 30, 32), (31, 30, 32)])
+        dst = numpy.empty(62 * 60 + 31 * 32 * 2, dtype=numpy.uint8)
+        planes = jp.decode_yuv(dst)
+        self.assertTrue((planes[0] == y).all())
+        self.assertTrue((planes[2] == v).all())
+        self.assertRaises(ValueError, jp.decode_yuv, dst[:-1])
+        gray = jpeg.JPEG(jpeg.JPEG(a[:, :, 0].copy()).encode()).decode_yuv()
+        self.assertEqual(len(gray), 1)
+
+    def test_sources(self):
+        ref = jpeg.JPEG(self.raw).decode()
+        data = self.raw.tobytes()
+        for src in (data, bytearray(data), memoryview(data)):
+            jp = jpeg.JPEG(src)
+            self.assertEqual(jp.source.nbytes, len(data))
+            self.assertTrue((jp.decode() == ref).all())
+        jp = jpeg.JPEG(jpeg.JPEG(data).source)
+        self.assertTrue((jp.decode() == ref).all())
+        fnme = os.path.join(os.path.dirname(__file__), "test.jpg")
+        jp = jpeg.JPEG(fnme, mmap=True)
+        self.assertIsInstance(jp.source, numpy.memmap)
+        self.assertTrue((jp.decode() == ref).all())
+
+    def test_pool(self):
+        pool = jpeg.HandlePool("tjInitDecompress", max_size=2)
+        lib = jpeg.JPEG(self.raw).lib_
+        h = pool.acquire(lib)
+        pool.release(h)
+        self.assertIs(pool.acquire(lib), h)
+        handles = [h] + [pool.acquire(lib) for _i in range(4)]
+        for h in handles:
+            pool.release(h)
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(pool.stats(), {"hits": 1, "misses": 5, "created": 5,
+                                        "destroyed": 2, "idle": 3})
+
+        def acquire_release():
+            pool.release(pool.acquire(lib))
+
+        for _i in range(80):
+            thread = threading.Thread(target=acquire_release)
+            thread.start()
+            thread.join()
+        gc.collect()
+        stats = pool.stats()
+        self.assertEqual(stats["created"], 5)
+        self.assertEqual(stats["hits"], 81)
+        self.assertEqual(stats["idle"], 3)
+        self.assertEqual(len(pool._slots), 1)
+        pool.clear()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool.stats()["destroyed"], 5)
+
+    def test_release(self):
+        with jpeg.JPEG(self.raw) as jp:
+            jp.decode()
+            self.assertIsNotNone(jp.decompressor)
+            before = len(jpeg.JPEG.decompressors)
+        self.assertIsNone(jp.decompressor)
+        self.assertEqual(len(jpeg.JPEG.decompressors), before + 1)
+        stats = jpeg.JPEG.stats()
+        self.assertEqual(sorted(stats),
+                         ["compressors", "decompressors", "transformers"])
+        self.assertGreaterEqual(stats["decompressors"]["hits"] +
+                                stats["decompressors"]["misses"], 1)
+
+    def test_read_header(self):
+        dirnme = os.path.dirname(__file__)
+        a = jpeg.JPEG(self.raw).decode()
+        for kwargs in (dict(subsampling=jpeg.TJSAMP_420),
+                       dict(subsampling=jpeg.TJSAMP_422)):
+            raw = jpeg.JPEG(a[:50, :40]).encode(**kwargs)
+            jp = jpeg.JPEG(raw)
+            jp.parse_header()
+            header = jpeg.read_header(raw)
+            self.assertEqual((header.width, header.height, header.subsampling),
+                             (jp.width, jp.height, jp.subsampling))
+            self.assertEqual(header.components, 3)
+            self.assertFalse(header.progressive)
+        header = jpeg.read_header(jpeg.JPEG(raw).transform(progressive=True))
+        self.assertTrue(header.progressive)
+        big = os.path.join(dirnme, "1024.jpg")
+        self.assertEqual(jpeg.read_header(big, chunk_size=16)[:2],
+                         (1024, 1024))
+        self.assertRaises(jpeg.JPEGRuntimeError, jpeg.read_header,
+                          raw[:20].tobytes())
+        self.assertRaises(jpeg.JPEGRuntimeError, jpeg.read_header, b"GIF89a")
+
+    def test_scan_headers(self):
+        dirnme = os.path.dirname(__file__)
+        paths = [os.path.join(dirnme, f)
+                 for f in ("1024.jpg", "64.jpg", "missing.jpg", "test_api.py")]
+        index = jpeg.scan_headers(paths, workers=2)
+        self.assertEqual(index.dtype, jpeg.HEADER_INDEX_DTYPE)
+        self.assertEqual(list(index["path_id"]), [0, 1, 2, 3])
+        self.assertEqual(list(index["width"]), [1024, 64, 0, 0])
+        self.assertEqual(index["file_size"][1], os.path.getsize(paths[1]))
+        self.assertEqual(index["subsampling"][2], jpeg.TJSAMP_UNKNOWN)
+        fnme = os.path.join(tempfile.mkdtemp(), "index.npy")
+        try:
+            jpeg.scan_headers(paths, fnme=fnme)
+            loaded = numpy.load(fnme, mmap_mode="r")
+            self.assertTrue((loaded == index).all())
+            del loaded
+        finally:
+            shutil.rmtree(os.path.dirname(fnme))
+
+    def test_aio(self):
+        import jpeg4py.aio as aio
+        ref = jpeg.JPEG(self.raw).decode()
+        decoder = aio.AsyncDecoder(workers=2, max_pending=2)
+
+        async def run():
+            jp = await aio.parse_header_async(self.raw, scale=0.5)
+            self.assertEqual((jp.scaled_width, jp.scaled_height), (32, 32))
+            self.assertIsNone(jp.decompressor)
+            results = await asyncio.gather(
+                *[decoder.decode(self.raw) for _i in range(8)])
+            for a in results:
+                self.assertTrue((a == ref).all())
+            a = await aio.decode_async(jp, pixfmt=jpeg.TJPF_GRAY)
+            self.assertEqual(a.shape, ref.shape[:2])
+            task = asyncio.ensure_future(decoder.decode(self.raw))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+        decoder.shutdown()
+        jpeg.JPEG.clear()
+
+    def test_process_decoder(self):
+        from jpeg4py.process import ProcessDecoder
+        big = os.path.join(os.path.dirname(__file__), "1024.jpg")
+        ref_big = jpeg.JPEG(big).decode(scale=(1, 8))
+        ref_small = jpeg.JPEG(self.raw).decode()
+        sources = [big, self.raw.tobytes(), big, self.raw.tobytes(), big]
+        with ProcessDecoder((128, 128), slots=3, workers=2,
+                            policy="resize") as decoder:
+            results = []
+            for a, size in decoder.imap(sources):
+                if size == (1024, 1024):
+                    results.append((a == ref_big).all())
+                else:
+                    results.append((a[::2, ::2] == ref_small).all())
+            del a
+        self.assertEqual(results, [True] * len(sources))
+
+    def test_decode_region(self):
+        jp = jpeg.JPEG(os.path.join(os.path.dirname(__file__), "1024.jpg"))
+        ref = jp.decode()
+        for region in ((100, 205, 300, 17), (0, 0, 8, 8), (1000, 1000, 24, 24),
+                       (0, 0, 1024, 1024)):
+            x, y, w, h = region
+            a = jp.decode(region=region)
+            self.assertEqual(a.shape, (h, w, 3))
+            self.assertTrue((a == ref[y:y + h, x:x + w]).all())
+        dst = numpy.zeros((20, 20), dtype=numpy.uint8)
+        a = jp.decode(dst, pixfmt=jpeg.TJPF_GRAY, region=(3, 5, 10, 10))
+        self.assertEqual(a.shape, (10, 10))
+        self.assertEqual(dst[10:].max(), 0)
+        self.assertRaises(ValueError, jp.decode, region=(1020, 0, 8, 8))
+        self.assertRaises(ValueError, jp.decode, region=(0, 0, 8, 8),
+                          scale=0.5)
+
+    def test_arena(self):
+        arena = jpeg.BufferArena(max_bytes=40000)
+        jp = jpeg.JPEG(self.raw)
+        ref = jp.decode()
+        a = jp.decode(arena=arena)
+        self.assertTrue((a == ref).all())
+        self.assertEqual(a.__array_interface__["data"][0] % 4096, 0)
+        ptr = a.__array_interface__["data"][0]
+        with arena.released(a):
+            pass
+        self.assertRaises(ValueError, arena.release, a)
+        b = jp.decode(arena=arena, pixfmt=jpeg.TJPF_BGR)
+        self.assertEqual(b.__array_interface__["data"][0], ptr)
+        del b
+        gc.collect()
+        self.assertEqual(arena.stats(), {
+            "hits": 1, "misses": 1, "evicted": 0, "idle": 1,
+            "idle_bytes": 16384, "leased": 0})
+        big = [arena.get((100, 100)) for _i in range(3)]
+        del big
+        gc.collect()
+        stats = arena.stats()
+        self.assertEqual(stats["evicted"], 1)
+        self.assertLessEqual(stats["idle_bytes"], 40000)
+        a = jp.decode(arena=arena, max_size=32)[:10]
+        saved = a.copy()
+        gc.collect()
+        self.assertEqual(arena.stats()["leased"], 1)
+        b = jp.decode(arena=arena, max_size=32, pixfmt=jpeg.TJPF_BGR)
+        self.assertNotEqual(b.__array_interface__["data"][0],
+                            a.__array_interface__["data"][0])
+        self.assertTrue((a == saved).all())
+        arena.release(a)
+        self.assertEqual(arena.stats()["leased"], 1)
+        jpeg.JPEG.arena = jpeg.BufferArena(hugepages=True)
+        try:
+            self.assertTrue((jp.decode() == ref).all())
+            self.assertEqual(jpeg.JPEG.arena.stats()["misses"], 1)
+        finally:
+            jpeg.JPEG.arena = None
+
+    def test_decode_modes(self):
+        jp = jpeg.JPEG(os.path.join(os.path.dirname(__file__), "1024.jpg"))
+        raw = jpeg.JPEG(jp.decode()).encode(subsampling=jpeg.TJSAMP_420)
+        jp = jpeg.JPEG(raw)
+        ref = jp.decode()
+        fast = jp.decode(mode="fast")
+        self.assertLess(numpy.abs(fast.astype(numpy.int32) - ref).mean(), 2)
+        self.assertFalse((fast == ref).all())
+        self.assertTrue(
+            (jp.decode(flags=jpeg.TJFLAG_FASTDCT |
+                       jpeg.TJFLAG_FASTUPSAMPLE) == fast).all())
+        self.assertEqual(jpeg.decode_flags("fastdct", jpeg.TJFLAG_BOTTOMUP),
+                         jpeg.TJFLAG_FASTDCT | jpeg.TJFLAG_BOTTOMUP)
+        self.assertRaises(ValueError, jp.decode, mode="fastest")
+        jpeg.JPEG.default_flags = jpeg.DECODE_MODES["fast"]
+        try:
+            self.assertTrue((jp.decode() == fast).all())
+            self.assertTrue((jp.decode(mode="accurate") == ref).all())
+            batch = jpeg.decode_batch([raw], workers=1)
+            self.assertTrue((batch[0] == fast).all())
+        finally:
+            jpeg.JPEG.default_flags = 0
+        self.assertEqual(len(jp.decode_yuv(mode="fast")), 3)
+
+    def test_bench(self):
+        from jpeg4py import bench
+        results = bench.run(configs=[(64, jpeg.TJSAMP_420, 90)], n=5,
+                            threads=(1, 2), seconds=0.05)
+        image = results["images"]["64_420_q90"]
+        self.assertEqual(sorted(image),
+                         ["bytes", "header", "latency", "throughput"])
+        self.assertEqual(sorted(image["throughput"]), ["1", "2"])
+        self.assertGreater(image["latency"]["p50_us"], 0)
+        self.assertIn("overhead_us", results["overhead"])
+        self.assertEqual(bench.compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower["images"]["64_420_q90"]["latency"]["p50_us"] /= 2
+        self.assertEqual(
+            [r[0] for r in bench.compare(results, slower)],
+            ["images.64_420_q90.latency.p50_us"])
+        jpeg.JPEG.clear()
+
+    def test_metrics(self):
+        calls = []
+
+        def hook(*args):
+            calls.append(args)
+
+        jpeg.JPEG(self.raw).decode()
+        self.assertEqual(jpeg.metrics.snapshot()["ops"], {})
+        jpeg.metrics.enable()
+        jpeg.metrics.add_hook(hook)
+        try:
+            jpeg.JPEG(self.raw).decode()
+            jp = jpeg.JPEG(numpy.zeros(16, dtype=numpy.uint8))
+            self.assertRaises(jpeg.JPEGRuntimeError, jp.parse_header)
+            ops = jpeg.metrics.snapshot()["ops"]
+        finally:
+            jpeg.metrics.disable()
+            jpeg.metrics.remove_hook(hook)
+            jpeg.metrics.reset()
+        header = ops["tjDecompressHeader2"]
+        self.assertEqual(header["calls"], 2)
+        self.assertEqual(header["errors"], {-1: 1})
+        self.assertEqual(header["bytes_in"], self.raw.nbytes + 16)
+        decode = ops["tjDecompress2"]
+        self.assertEqual(decode["pixels_out"], 64 * 64)
+        self.assertEqual(sum(decode["histogram"].values()), 1)
+        self.assertIn("alloc", ops)
+        self.assertEqual(len(calls), sum(op["calls"] for op in ops.values()))
+        self.assertIn("decompressors", jpeg.metrics.snapshot()["pools"])
+
+    def test_abi_fallback(self):
+        from jpeg4py._build import CDEF
+        import cffi
+        jpeg.initialize()
+        ffi = cffi.FFI()
+        ffi.cdef(CDEF)
+        try:
+            abi = ffi.dlopen("libturbojpeg.so.0")
+        except OSError:
+            self.skipTest("libturbojpeg.so.0 is not available")
+        big = os.path.join(os.path.dirname(__file__), "1024.jpg")
+        ref = jpeg.JPEG(big).decode()
+        for raw in (self.raw, numpy.fromfile(big, numpy.uint8),
+                    jpeg.JPEG(ref).encode(subsampling=jpeg.TJSAMP_420)):
+            headers, regions = [], []
+            for lib_ in (None, abi):
+                jp = jpeg.JPEG(raw, lib_=lib_)
+                jp.parse_header()
+                headers.append((jp.width, jp.height, jp.subsampling))
+                jp.release()
+                jp = jpeg.JPEG(raw)
+                if lib_ is not None:
+                    # Lossless transform instead of TurboJPEG 3 cropping
+                    jp._has_tj3 = lambda: False
+                regions.append(jp.decode(region=(17, 9, 40, 30)))
+                jp.release()
+            self.assertEqual(headers[0], headers[1])
+            self.assertTrue((regions[0] == regions[1]).all())
+        jp = jpeg.JPEG(numpy.zeros(16, dtype=numpy.uint8))
+        self.assertRaises(jpeg.JPEGRuntimeError, jp.parse_header)
+        jp.release()
+
+    def test_stream(self):
+        import tarfile
+        import zipfile
+        dirnme = os.path.dirname(__file__)
+        names = ["test.jpg", "1024.jpg", "test.jpg"]
+        refs = [jpeg.JPEG(os.path.join(dirnme, n)).decode() for n in names]
+        tmp = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmp, "d"))
+            with tarfile.open(os.path.join(tmp, "a.tar"), "w",
+                              dereference=True) as tar, \
+                    zipfile.ZipFile(os.path.join(tmp, "a.zip"), "w") as zf:
+                for i, n in enumerate(names):
+                    key = "%06d.jpg" % i
+                    tar.add(os.path.join(dirnme, n), key)
+                    zf.write(os.path.join(dirnme, n), key)
+                    shutil.copy(os.path.join(dirnme, n),
+                                os.path.join(tmp, "d", key))
+                tar.add(os.path.join(dirnme, "test_api.py"), "skipped.py")
+            keys = ["%06d.jpg" % i for i in range(len(names))]
+            for src in ("a.tar", "a.zip", "d"):
+                items = list(jpeg.stream(os.path.join(tmp, src), workers=2,
+                                         read_ahead=1))
+                self.assertEqual([k for k, _ in items], keys)
+                for (_, a), ref in zip(items, refs):
+                    self.assertTrue((a == ref).all())
+            with open(os.path.join(tmp, "a.tar"), "rb") as fin:
+                it = jpeg.stream(fin, workers=1, max_size=(32, 32))
+                key, a = next(it)
+                it.close()
+            self.assertEqual((key, a.shape), ("000000.jpg", (32, 32, 3)))
+            it = jpeg.stream(os.path.join(tmp, "d"), workers=1)
+            items = [next(it)]
+            jpeg.decode_batch([self.raw] * 8, workers=4)
+            items.extend(it)
+            self.assertEqual([k for k, _ in items], keys)
+            with open(os.path.join(tmp, "d", "000001.jpg"), "wb") as fout:
+                fout.write(b"\xff\xd8garbage")
+            self.assertRaises(jpeg.JPEGRuntimeError, list,
+                              jpeg.stream(os.path.join(tmp, "d")))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_pipeline(self):
+        big = os.path.join(os.path.dirname(__file__), "1024.jpg")
+        sources = [self.raw, big] * 5
+        small = jpeg.JPEG(self.raw).decode()
+        with jpeg.Pipeline(sources, workers=3, batch_size=4) as p:
+            batches = list(p)
+            stats = p.stats()
+        self.assertEqual([len(b) for b in batches], [4, 4, 2])
+        images = sum(batches, [])
+        self.assertEqual([a.shape[0] for a in images], [64, 1024] * 5)
+        self.assertTrue((images[0] == small).all())
+        self.assertEqual(stats["decode"]["count"], 10)
+        self.assertEqual(stats["read"]["count"], 10)
+        self.assertEqual(stats["ready"], 0)
+        p = jpeg.Pipeline(iter(sources), [lambda a: a[:8]], workers=2,
+                          ordered=False, prefetch=1)
+        images = list(p)
+        self.assertEqual(len(images), 10)
+        self.assertTrue(all(a.shape[0] == 8 for a in images))
+        self.assertEqual(p.stats()["transform"]["count"], 10)
+        p = jpeg.Pipeline(sources * 10, workers=2, prefetch=1)
+        it = iter(p)
+        next(it)
+        time.sleep(0.1)
+        self.assertLessEqual(p.stats()["decode"]["count"], 4)
+        it.close()
+        self.assertFalse(any(t.is_alive() for t in p._threads))
+        bad = [self.raw, numpy.zeros(16, numpy.uint8), self.raw]
+        it = iter(jpeg.Pipeline(bad, workers=2))
+        next(it)
+        self.assertRaises(jpeg.JPEGRuntimeError, next, it)
+
+    def test_decode_cache(self):
+        cache = jpeg.DecodeCache(max_bytes=64 * 64 * 3 * 2)
+        ref = jpeg.JPEG(self.raw).decode()
+        a = jpeg.JPEG(self.raw).decode(cache=cache)
+        b = jpeg.JPEG(self.raw.copy()).decode(cache=cache)
+        self.assertIs(a, b)
+        self.assertTrue((a == ref).all())
+        self.assertFalse(a.flags.writeable)
+        jpeg.JPEG(self.raw).decode(cache=cache, pixfmt=jpeg.TJPF_BGR)
+        jpeg.JPEG(self.raw).decode(cache=cache, max_size=(32, 32))
+        c = jpeg.JPEG(self.raw).decode(cache=cache, max_size=(32, 32))
+        self.assertEqual(c.shape, (32, 32, 3))
+        self.assertEqual(len(cache), 2)
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 3))
+        self.assertAlmostEqual(stats["hit_rate"], 0.4)
+        self.assertEqual(stats["evicted"], 1)
+        jpeg.JPEG.cache = cache
+        try:
+            d = jpeg.JPEG(self.raw).decode(max_size=(32, 32))
+            self.assertIs(d, c)
+            self.assertIsNot(jpeg.JPEG(self.raw).decode(max_size=(32, 32),
+                                                        cache=False), c)
+        finally:
+            jpeg.JPEG.cache = None
+        big = os.path.join(os.path.dirname(__file__), "1024.jpg")
+        self.assertTrue(jpeg.JPEG(big).decode(cache=cache).flags.writeable)
+        self.assertEqual(len(cache), 2)
+        cache.clear()
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_decode_strips(self):
+        big = jpeg.JPEG(os.path.join(os.path.dirname(__file__), "1024.jpg"))
+        ref = big.decode()
+        mcu_h = jpeg.tjMCUHeight[big.subsampling]
+        rows = -(-100 // mcu_h) * mcu_h
+        ys, bases = [], set()
+        out = numpy.empty_like(ref)
+        for y, band in big.decode_strips(100):
+            ys.append(y)
+            bases.add(id(band.base))
+            out[y:y + band.shape[0]] = band
+        self.assertEqual(ys, list(range(0, 1024, rows)))
+        self.assertEqual(len(bases), 1)
+        self.assertTrue((out == ref).all())
+        jp = jpeg.JPEG(jpeg.JPEG(ref).encode(subsampling=jpeg.TJSAMP_420))
+        ref = jp.decode()
+        for y, band in jp.decode_strips(20):
+            self.assertTrue((band == ref[y:y + band.shape[0]]).all())
+        self.assertEqual(y, 1023 // 32 * 32)
+        small = jpeg.JPEG(self.raw)
+        bands = [b for _, b in small.decode_strips(
+            1000, pixfmt=jpeg.TJPF_GRAY)]
+        self.assertEqual(len(bands), 1)
+        self.assertEqual(bands[0].shape, (64, 64))
+        self.assertRaises(ValueError, small.decode_strips, 0)
+
+    def test_decode_tensor(self):
+        jp = jpeg.JPEG(self.raw)
+        a = jp.decode().astype(numpy.float32)
+        mean, std = (120.0, 110.0, 100.0), (60.0, 55.0, 50.0)
+        ref = (a - numpy.array(mean, numpy.float32)) / numpy.array(std)
+        t = jp.decode_tensor(mean=mean, std=std)
+        self.assertEqual((t.shape, t.dtype), ((3, 64, 64), numpy.float32))
+        self.assertLess(numpy.abs(t - ref.transpose(2, 0, 1)).max(), 1e-5)
+        t = jp.decode_tensor("HWC", numpy.float16, mean, std)
+        self.assertEqual((t.shape, t.dtype), ((64, 64, 3), numpy.float16))
+        self.assertLess(numpy.abs(t - ref).max(), 1e-2)
+        t = jp.decode_tensor(std=255, pixfmt=jpeg.TJPF_GRAY, scale=0.5)
+        self.assertEqual(t.shape, (1, 32, 32))
+        self.assertLessEqual(t.max(), 1)
+        self.assertRaises(ValueError, jp.decode_tensor, "NCHW")
+        self.assertRaises(ValueError, jp.decode_tensor,
+                          out=numpy.empty((64, 64, 3), numpy.float32))
+        self.assertRaises(ValueError, jp.decode_tensor,
+                          out=numpy.empty((3, 64, 64), numpy.uint8))
+        batch = jpeg.decode_batch_tensor([self.raw, self.raw], mean=mean,
+                                         std=std, workers=2)
+        self.assertEqual(batch.shape, (2, 3, 64, 64))
+        self.assertLess(numpy.abs(batch - ref.transpose(2, 0, 1)).max(),
+                        1e-5)
+        out = numpy.empty((1, 80, 70, 1), numpy.float32)
+        jpeg.decode_batch_tensor([self.raw], out, "HWC",
+                                 pixfmt=jpeg.TJPF_GRAY)
+        gray = jp.decode(pixfmt=jpeg.TJPF_GRAY)
+        self.assertTrue((out[0, :64, :64, 0] == gray).all())
+        self.assertEqual(out[0, 64:].max(), 0)
+        self.assertRaises(ValueError, jpeg.decode_batch_tensor, [self.raw],
+                          out, "CHW", pixfmt=jpeg.TJPF_GRAY)
+
+    def test_thumbnails(self):
+        big = jpeg.JPEG(os.path.join(os.path.dirname(__file__), "1024.jpg"))
+        thumbs = jpeg.thumbnails(big, [128, (300, 200), 512, 2048],
+                                 quality=90)
+        sizes = []
+        for data in thumbs:
+            jp = jpeg.JPEG(data)
+            jp.parse_header()
+            sizes.append((jp.width, jp.height))
+        self.assertEqual(sizes, [(128, 128), (200, 200), (512, 512),
+                                 (1024, 1024)])
+        ref = big.decode(scale=(1, 8)).astype(int)
+        a = jpeg.JPEG(thumbs[0]).decode()
+        self.assertLess(numpy.abs(a - ref).mean(), 4)
+        gray = jpeg.thumbnails(self.raw, [(50, 20)], pixfmt=jpeg.TJPF_GRAY)
+        jp = jpeg.JPEG(gray[0])
+        self.assertEqual(jp.decode(pixfmt=jpeg.TJPF_GRAY).shape, (20, 20))
+        self.assertEqual(jp.subsampling, jpeg.TJSAMP_GRAY)
+        self.assertRaises(ValueError, jpeg.thumbnails, self.raw, [0])
+
+    def test_encode_to_size(self):
+        yy, xx = numpy.mgrid[:96, :128]
+        noise = numpy.random.RandomState(0).randint(0, 40, (96, 128, 3))
+        img = (numpy.dstack([xx * 2, yy * 2, xx + yy]) + noise).astype(
+            numpy.uint8)
+        sizes = [jpeg.JPEG(img).encode(quality=q).nbytes
+                 for q in range(1, 96)]
+        for budget in (sizes[20], sizes[60] + 100, sizes[-1] * 2):
+            data, quality = jpeg.encode_to_size(img, budget)
+            self.assertLessEqual(data.nbytes, budget)
+            self.assertEqual(quality, max(q for q, n in
+                                          enumerate(sizes, 1) if n <= budget))
+            self.assertTrue((data == jpeg.JPEG(img).encode(
+                quality=quality)).all())
+        data, quality = jpeg.encode_to_size(img[:, :, 0].copy(), 1 << 20,
+                                            max_quality=50)
+        self.assertEqual(quality, 50)
+        self.assertEqual(jpeg.JPEG(data).decode(
+            pixfmt=jpeg.TJPF_GRAY).shape, (96, 128))
+        self.assertRaises(ValueError, jpeg.encode_to_size, img, 100)
+        self.assertRaises(ValueError, jpeg.encode_to_size, img, 1000,
+                          min_quality=50, max_quality=40)
+
+    def test_validate(self):
+        data = jpeg.JPEG(jpeg.JPEG(os.path.join(
+            os.path.dirname(__file__), "1024.jpg")).decode()).encode()
+        self.assertEqual(jpeg.validate(data).status, "valid")
+        self.assertEqual(jpeg.validate(os.path.join(
+            os.path.dirname(__file__), "64.jpg")).status, "valid")
+        for n in (1, 100, data.nbytes // 2, data.nbytes - 1):
+            self.assertEqual(jpeg.validate(data[:n]).status, "truncated")
+        self.assertEqual(jpeg.validate(b"GIF89a").status, "corrupt")
+        corrupt = data.copy()
+        corrupt[5000:5002] = (0xFF, 0x11)
+        self.assertEqual(jpeg.validate(corrupt), jpeg.Validation(
+            "corrupt", 5000, "Unexpected marker 0x11"))
+        sof = bytes.fromhex("FFD8 FFC0000B080010001001011100")
+        sos = bytes.fromhex("FFDA000801010000 3F00")
+        dri = bytes.fromhex("FFDD00040001")
+        scan = bytes.fromhex("1234FFD056FF00FFD178")
+        self.assertEqual(jpeg.validate(sof + dri + sos + scan + b"\xFF\xD9"),
+                         ("valid", 43, ""))
+        self.assertEqual(jpeg.validate(sof + sos + scan + b"\xFF\xD9")[0],
+                         "corrupt")
+        self.assertEqual(jpeg.validate(
+            sof + dri + sos + scan.replace(b"\xD1", b"\xD3") +
+            b"\xFF\xD9")[1:], (38, "Restart markers out of order"))
+        self.assertEqual(jpeg.validate(sos + sof + b"\xFF\xD9")[0],
+                         "corrupt")
+        self.assertEqual(jpeg.validate(sof + b"\xFF\xD9")[0], "corrupt")
+
+        jp = jpeg.JPEG(data)
+        ref = jp.decode()
+        image, complete = jp.decode(on_error="partial")
+        self.assertTrue(complete)
+        self.assertIs(image.base, None)
+        truncated = jpeg.JPEG(data[:data.nbytes // 2].copy())
+        self.assertRaises(jpeg.JPEGRuntimeError, truncated.decode)
+        self.assertIsNone(truncated.decode(on_error="skip"))
+        image, complete = truncated.decode(on_error="partial")
+        self.assertFalse(complete)
+        self.assertEqual(image.shape[1:], ref.shape[1:])
+        self.assertTrue((image == ref[:image.shape[0]]).all())
+        if jpeg.capabilities()["tj3"]:
+            self.assertGreater(image.shape[0], 256)
+        self.assertEqual(jpeg.JPEG(b"GIF89a").decode(on_error="partial"),
+                         (None, False))
+        self.assertRaises(ValueError, jp.decode, on_error="ignore")
+        self.assertRaises(ValueError, jp.decode, region=(0, 0, 8, 8),
+                          on_error="partial")
+
+    def test_tj3(self):
+        if not jpeg.capabilities()["tj3"]:
+            self.skipTest("TurboJPEG 3 API is not available")
+        yy, xx = numpy.mgrid[:48, :80]
+        img = numpy.dstack([xx * 50, yy * 80, (xx + yy) * 30]).astype(
+            numpy.uint16)
+        jp = jpeg.JPEG(jpeg.JPEG(img).encode(quality=100))
+        a = jp.decode()
+        self.assertEqual((jp.precision, jp.lossless, a.dtype),
+                         (12, False, numpy.uint16))
+        self.assertLess(numpy.abs(a.astype(int) - img).max(), 64)
+        self.assertTrue((jp.decode(region=(19, 5, 30, 20)) ==
+                         a[5:25, 19:49]).all())
+        bands = [b.copy() for _, b in jp.decode_strips(10)]
+        self.assertTrue((numpy.vstack(bands) == a).all())
+        gray = (xx * 800 + yy).astype(numpy.uint16)
+        jp = jpeg.JPEG(jpeg.JPEG(gray).encode(lossless=True))
+        a = jp.decode(pixfmt=jpeg.TJPF_GRAY)
+        self.assertEqual((jp.precision, jp.lossless), (16, True))
+        self.assertTrue((a == gray).all())
+        rgb = jpeg.JPEG(self.raw).decode()
+        jp = jpeg.JPEG(jpeg.JPEG(rgb).encode(lossless=True))
+        self.assertTrue((jp.decode() == rgb).all())
+        jp = jpeg.JPEG(jpeg.JPEG(rgb).encode())
+        jp.parse_header()
+        self.assertEqual((jp.precision, jp.lossless, jp.progressive),
+                         (8, False, False))
+        self.assertRaises(ValueError, jpeg.JPEG(gray).encode, precision=8)
+
 
 if __name__ == "__main__":
     unittest.main()